@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# Requests/second through the /tasks/add build path -- one build_task per request vs one build_tasks per batch
+# usage: add_throughput.py [batch size ...]
+
+import os
+import sys
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lib import Task, Client, hexify
+
+HELD = 'benchmark-held'
+
+
+def per_request(requests):
+    for req in requests:
+        Task.prepare(**req).insert(status=HELD)
+
+
+def batched(requests):
+    _, errors = Task.build_many(requests, status=HELD)
+    assert not errors, errors
+
+
+def run(sizes=(100, 1000, 10000)):
+    print('{:>8} {:>16} {:>16}'.format('batch', 'per request/s', 'batched/s'))
+    for size in sizes:
+        rates = []
+        for fn in (per_request, batched):
+            user = 'benchmark-{}'.format(hexify())
+            requests = [{'cmd': ['true', str(i)], 'user': user, 'log': os.devnull} for i in range(size)]
+            started = time()
+            fn(requests)
+            rates.append(size / (time() - started))
+            Client.remove('task', {'user': user})
+        print('{:>8} {:>16.1f} {:>16.1f}'.format(size, *rates))
+
+
+if __name__ == '__main__':
+    run([int(x) for x in sys.argv[1:]] or (100, 1000, 10000))
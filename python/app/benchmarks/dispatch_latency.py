@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# Time from insert to 'fetched' for tasks added to an idle pool -- run against a live proc_run.py
+# usage: dispatch_latency.py [samples]
+
+import os
+import sys
+from time import time, sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lib import build_task, notify_runner, states, Client
+
+
+def wait_for_dispatch(task, timeout=30):
+    started = time()
+    while time() - started < timeout:
+        doc = Client.find_one('task', {'_id': task.id})
+        if doc and doc.get('status') not in states.queued:
+            return time()
+    raise RuntimeError('Task {} was not dispatched within {}s -- is proc_run.py running?'.format(task.name, timeout))
+
+
+def run(samples=20):
+    latencies = []
+    for _ in range(samples):
+        inserted = time()
+        task = build_task(['true'], user='benchmark')
+        notify_runner()
+        latencies.append((wait_for_dispatch(task) - inserted) * 1000)
+        # let the slot free up so every sample lands on an idle pool
+        sleep(0.2)
+
+    latencies.sort()
+    print('samples: {}'.format(samples))
+    print('min:     {:.2f}ms'.format(latencies[0]))
+    print('median:  {:.2f}ms'.format(latencies[len(latencies) // 2]))
+    print('p95:     {:.2f}ms'.format(latencies[int(len(latencies) * 0.95) - 1]))
+    print('max:     {:.2f}ms'.format(latencies[-1]))
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
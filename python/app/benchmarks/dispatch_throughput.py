@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# Tasks/second through a live proc_run.py for a burst of trivial commands
+# usage: dispatch_throughput.py [count] [cmd ...]
+
+import os
+import sys
+from time import time, sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lib import Task, Client, notify_runner, states, hexify, now
+
+HELD = 'benchmark-held'
+
+
+def stage(count, cmd, user):
+    # Insert everything in a status the runner ignores so the clock only covers dispatch
+    for _ in range(count):
+        Task({'cmd': cmd, 'log': os.devnull, 'priority': 100, 'user': user, 'init_time': now()}).insert(status=HELD)
+
+
+def run(count=1000, cmd=None):
+    cmd = cmd or ['true']
+    user = 'benchmark-{}'.format(hexify())
+
+    stage(count, cmd, user)
+    print('staged {} x {}'.format(count, ' '.join(cmd)))
+
+    started = time()
+    Client.update_many('task', {'user': user, 'status': HELD}, {'$set': {'status': states.queued[0]}})
+    notify_runner()
+
+    done = 0
+    while done < count:
+        sleep(0.05)
+        done = Client.count('task', {'user': user, 'status': {'$in': states.complete}})
+    elapsed = time() - started
+
+    print('elapsed: {:.2f}s'.format(elapsed))
+    print('tasks/s: {:.1f}'.format(count / elapsed))
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1000, sys.argv[2:])
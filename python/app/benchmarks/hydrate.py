@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# Cost of turning database rows into Task objects -- no database needed
+# usage: hydrate.py [documents] [rounds]
+
+import os
+import sys
+import inspect
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lib import Task, UserFault, now
+
+
+class FrameInspectingTask(Task):
+    """
+    Task with the old frame-inspecting __setattr__, kept here as the 'before' measurement
+    """
+
+    __slots__ = ()
+
+    def __setattr__(self, key, value):
+        previous_frame = inspect.currentframe().f_back.f_code.co_name
+        try:
+            if previous_frame not in ('__init__', 'insert', 'remove'):
+                assert not key.startswith('_')
+            object.__setattr__(self, key, value)
+        except (AttributeError, AssertionError):
+            raise UserFault('bad key {}'.format(key))
+
+
+def rows(count):
+    return [{
+        '_id': '{:024x}'.format(i),
+        'cmd': ['true', str(i)],
+        'log': '/var/log/proc_pool/{}.log'.format(i),
+        'init_time': now(),
+        'priority': 100,
+        'status': 'finished',
+        'user': 'benchmark',
+        'exit_code': 0,
+        'notes': [{'text': 'task created', 'timestamp': now(), 'user': 'benchmark'}],
+    } for i in range(count)]
+
+
+def best(fn, rounds):
+    timings = []
+    for _ in range(rounds):
+        started = time()
+        fn()
+        timings.append(time() - started)
+    return min(timings)
+
+
+def run(count=10000, rounds=5):
+    documents = rows(count)
+    results = [
+        ('frame inspection (before)', best(lambda: [FrameInspectingTask(x) for x in documents], rounds)),
+        ('Task(row)', best(lambda: [Task(x) for x in documents], rounds)),
+        ('Task.hydrate(rows)', best(lambda: Task.hydrate(documents), rounds)),
+    ]
+    print('{} documents, best of {}'.format(count, rounds))
+    for name, seconds in results:
+        print('{:<28} {:8.1f}ms  {:6.2f}us/doc'.format(name, seconds * 1000, seconds * 1e6 / count))
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 5)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# Tasks/second through a live proc_run.py for trivial commands run one per slot vs packed into micro batches -- the
+# runner needs config > startup > micro_batch > size set for the second round to batch anything
+# usage: micro_batch_throughput.py [count] [cmd ...]
+
+import os
+import sys
+from time import time, sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lib import Client, notify_runner, states, hexify, now, micro_batch_size
+
+HELD = 'benchmark-held'
+
+
+def stage(count, cmd, user, micro_batch):
+    # Insert everything in a status the runner ignores so the clock only covers dispatch
+    log = os.path.join('/tmp', '{}.log'.format(user))
+    Client.insert_many('task', [
+        {'cmd': cmd, 'log': log, 'priority': 100, 'user': user, 'init_time': now(), 'micro_batch': micro_batch or None,
+         'status': HELD} for _ in range(count)
+    ])
+    return log
+
+
+def rate(count, cmd, micro_batch):
+    user = 'benchmark-{}'.format(hexify())
+    log = stage(count, cmd, user, micro_batch)
+
+    started = time()
+    Client.update_many('task', {'user': user, 'status': HELD}, {'$set': {'status': states.queued[0]}})
+    notify_runner()
+
+    done = 0
+    while done < count:
+        sleep(0.05)
+        done = Client.count('task', {'user': user, 'status': {'$in': states.complete}})
+    elapsed = time() - started
+
+    if os.path.exists(log):
+        os.remove(log)
+    return count / elapsed
+
+
+def run(count=2000, cmd=None):
+    cmd = cmd or ['true']
+    print('{} x {}, micro batch size {}'.format(count, ' '.join(cmd), micro_batch_size or 'off'))
+
+    single = rate(count, cmd, False)
+    print('one per slot: {:.1f} tasks/s'.format(single))
+    batched = rate(count, cmd, True)
+    print('micro batched: {:.1f} tasks/s'.format(batched))
+    print('speedup: {:.1f}x'.format(batched / single))
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 2000, sys.argv[2:])
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# Time for Proc.start to launch `true` with Popen in the runner (with and without the preexec_fn the cgroup mode adds,
+# which rules out vfork) vs through the zygote, while the runner already supervises 1, 100 and 1000 idle children (one
+# thread and three pipes each) on top of a heap of ballast -- no database
+# usage: spawn_latency.py [samples] [ballast MB]
+
+import os
+import sys
+from time import perf_counter
+from functools import partial
+from threading import Thread
+from signal import SIGKILL
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lib import Proc, hexify
+from lib.manager import Zygote
+
+# Started before anything else, like ProcPool does at startup
+ZYGOTE = Zygote()
+
+CONCURRENCY = (1, 100, 1000)
+
+
+class StandInTask(object):
+
+    def __init__(self, cmd):
+        self.name = hexify()
+        self._id = self.name
+        self.cmd = cmd
+        self.cwd = None
+        self.env = None
+        self.log = None
+        self.stdin = None
+
+    def __getattr__(self, item):
+        return None
+
+    def commit(self, status=None, **kwargs):
+        pass
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def stand_in(cmd, zygote, preexec):
+    proc = Proc(StandInTask(cmd), zygote=zygote)
+    if preexec:
+        proc.callback = partial(proc.callback, preexec_fn=os.getpid)
+    return proc
+
+
+def measure(zygote, concurrency, samples, preexec=False):
+    idle = [stand_in(['sleep', '3600'], zygote, preexec) for _ in range(concurrency)]
+    threads = []
+    for proc in idle:
+        proc.start(log=False)
+        t = Thread(target=proc.reap)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    latencies = []
+    for _ in range(samples):
+        proc = stand_in(['true'], zygote, preexec)
+        started = perf_counter()
+        proc.start(log=False)
+        latencies.append(perf_counter() - started)
+        proc.stream()
+        proc.reap()
+
+    for proc in idle:
+        proc.signal_group(SIGKILL)
+    for t in threads:
+        t.join()
+    for proc in idle:
+        proc.stream()
+    return latencies
+
+
+def run(samples=200, ballast_mb=256):
+    # Stands in for thousands of Task objects -- every page is touched so a fork would have to copy its page tables
+    ballast = [bytearray(1024 * 1024) for _ in range(ballast_mb)]
+    for chunk in ballast:
+        chunk[::4096] = b'\x01' * len(chunk[::4096])
+
+    print('{:<16} {:>12} {:>10} {:>10}'.format('spawner', 'concurrency', 'p50 ms', 'p99 ms'))
+    for concurrency in CONCURRENCY:
+        for name, zygote, preexec in (('popen', None, False), ('popen+preexec_fn', None, True),
+                                      ('zygote', ZYGOTE, False)):
+            latencies = measure(zygote, concurrency, samples, preexec)
+            print('{:<16} {:>12} {:>10.3f} {:>10.3f}'.format(name, concurrency, percentile(latencies, 0.5) * 1000,
+                                                           percentile(latencies, 0.99) * 1000))
+
+
+if __name__ == '__main__':
+    run(*[int(x) for x in sys.argv[1:3]])
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# Runner memory, threads and CPU while supervising idle children -- no database writes, tasks are stand-ins
+# usage: supervisor_idle.py [threads|selector] [children] [idle seconds]
+
+import os
+import sys
+import resource
+import threading
+from time import time, sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lib import ProcPool, Proc, hexify
+
+
+class IdleTask(object):
+
+    def __init__(self):
+        self.name = hexify()
+        self._id = self.name
+        self.cmd = ['sleep', '3600']
+        self.cwd = None
+        self.env = None
+        self.log = os.devnull
+        self.stdin = None
+        self.timeout = None
+        self.parent_url = ''
+        self.priority = 100
+        self.status = None
+
+    def __getattr__(self, item):
+        return None
+
+    def __lt__(self, other):
+        return self.priority >= other.priority
+
+    def commit(self, status=None, **kwargs):
+        if status:
+            self.status = status
+
+
+def rss_kb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+def cpu_seconds():
+    t = os.times()
+    return t.user + t.system
+
+
+def run(supervisor='threads', children=1000, idle=10):
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    pool = ProcPool(children, supervisor=supervisor)
+    tasks = [IdleTask() for _ in range(children)]
+    baseline_rss, baseline_threads = rss_kb(), threading.active_count()
+
+    pool.start(lambda: tasks, lambda count: [], poll_interval=3600)
+    while sum(1 for t in tasks if t.status == Proc.PROCESSING) < children:
+        sleep(0.1)
+    sleep(1)
+
+    rss, threads = rss_kb(), threading.active_count()
+    cpu_started, started = cpu_seconds(), time()
+    sleep(idle)
+    cpu = cpu_seconds() - cpu_started
+    wall = time() - started
+
+    print('supervisor: {} -- {} idle children'.format(supervisor, children))
+    print('threads:    {} (+{})'.format(threads, threads - baseline_threads))
+    print('rss:        {:.1f}MB (+{:.1f}KB per child)'.format(rss / 1024.0, (rss - baseline_rss) / float(children)))
+    print('cpu:        {:.3f}s over {:.1f}s idle ({:.2f}%)'.format(cpu, wall, 100 * cpu / wall))
+
+    for proc in list(pool.running):
+        proc.kill()
+
+
+if __name__ == '__main__':
+    run(sys.argv[1] if len(sys.argv) > 1 else 'threads',
+        int(sys.argv[2]) if len(sys.argv) > 2 else 1000,
+        float(sys.argv[3]) if len(sys.argv) > 3 else 10)
@@ -1,8 +1,14 @@
 import os
-from .mongo import Document, UserFault, ApplicationFault, Client, InvalidId
+import socket
+from time import sleep
+from datetime import timedelta
+from .mongo import Document, UserFault, ApplicationFault, Client, InvalidId, validate_object_id
 from .config import Config, KeyNotAvailableError
-from .manager import ProcPool, Thread, hexify, TIME_FORMAT, timestamp, Proc
+from .manager import ProcPool, FairPool, Thread, hexify, TIME_FORMAT, timestamp, now, format_time, Proc
 from .logger import get_logger as __get_logger, stream_logger
+from .notify import Notifier
+from .cgroup import CGroupTree
+from .tail import parse_range, tail_offset, read_range, follow_log
 
 
 __FILE_DIR = os.path.dirname(__file__)
@@ -20,27 +26,154 @@ assert config.runtime.app.endpoints, "Please set config > runtime > app > endpoi
 
 
 concurrency = config.startup.concurrency or 1
+capacity_cpus = (config.startup.capacity and config.startup.capacity.cpus) or concurrency
+capacity_memory_mb = config.startup.capacity and config.startup.capacity.memory_mb
+cgroup = config.startup.cgroup
+fair_share = config.startup.fair_share
+micro_batch_size = (config.startup.micro_batch and config.startup.micro_batch.size) or 0
+timeout_grace = config.startup.timeout_grace or 10
+supervisor = config.startup.supervisor or 'threads'
+spawner = config.startup.spawner or 'popen'
+output_tail = config.runtime.task.output_tail or 65536
 task_extra_fields = tuple(config.runtime.task.extra_fields or [])
 task_formattable_fields = tuple(config.runtime.task.formattable_fields or [])
 endpoints = config.runtime.app.endpoints
 states = config.runtime.task.states
 logpath = config.startup.log.path or '/tmp/proc_pool.log'
 log_level = config.startup.log.level or 'debug'
+notify_socket = (config.startup.notify and config.startup.notify.socket) or '/var/shared/proc_run.sock'
+poll_interval = (config.startup.notify and config.startup.notify.poll_interval) or 10
+check_indexes = config.startup.db.check_indexes is not False
+archive = config.runtime.task.archive
+page_size = config.runtime.app.page_size or 1000
+max_page_size = config.runtime.app.max_page_size or 10000
+worker_id = config.startup.worker_id or socket.gethostname()
+heartbeat_interval = (config.startup.heartbeat and config.startup.heartbeat.interval) or 30
+worker_timeout = (config.startup.heartbeat and config.startup.heartbeat.timeout) or 300
+assert worker_timeout > heartbeat_interval, "config > startup > heartbeat > timeout has to be longer than its interval"
+
+
+WORKERS = 'worker'
 
 
 def app_logger(x, path=logpath, level=log_level): return __get_logger(x, logpath=path, level=level)
 
 
-Client.set(config.startup.db.url, config.startup.db.name)
+__NOTIFIER = Notifier(notify_socket, worker_id)
+
+
+def notify_runner(): return __NOTIFIER.notify()
+
+
+def listen_for_tasks(callback): return __NOTIFIER.listen(callback)
 
 
 def build_task(cmd, **kwargs): return Task.build(cmd, **kwargs)
 
 
+def build_tasks(requests, **kwargs): return Task.build_many(requests, **kwargs)
+
+
+__LOG_DIRS = set()
+
+
+def ensure_log_dir(log):
+    """
+    Create a task log's directory once per process -- bulk adds mostly share a handful of directories
+    """
+    if not log:
+        return
+    log_dir = os.path.dirname(log)
+    if log_dir and log_dir not in __LOG_DIRS:
+        if not os.path.exists(log_dir):
+            os.makedirs(log_dir, exist_ok=True)
+        __LOG_DIRS.add(log_dir)
+
+
 def query(query_data):
     return Task.query(query_data)
 
 
+def query_page(query_data, limit=None, after=None, by_priority=False, full=False, paged=True):
+    """
+    One page of raw task rows straight from a cursor, in _id order or in dispatch order (priority desc, _id)
+    :param query_data:
+    :param limit: rows per page, capped at max_page_size
+    :param after: the `next` token of the previous page
+    :param by_priority:
+    :param full: fetch every field instead of just the ones Task.slim needs
+    :param paged: when False (streamed exports) there is no default or maximum page size
+    :return: (cursor, limit)
+    """
+    try:
+        if paged:
+            limit = min(int(limit or page_size), max_page_size)
+        else:
+            limit = int(limit or 0)
+        assert limit >= 0 and (limit or not paged)
+    except (ValueError, AssertionError):
+        raise UserFault('limit must be a positive integer')
+
+    bound = None
+    if after and by_priority:
+        try:
+            priority, oid = after.split(':', 1)
+            priority = int(priority)
+        except ValueError:
+            raise UserFault('after must be the "next" token of the previous page')
+        oid = validate_object_id(oid)
+        bound = {'$or': [{'priority': {'$lt': priority}}, {'priority': priority, '_id': {'$gt': oid}}]}
+    elif after:
+        bound = {'_id': {'$gt': validate_object_id(after)}}
+
+    sort = Task.DISPATCH_SORT if by_priority else [('_id', 1)]
+    projection = None if full else list(Task.SLIM_FIELDS)
+
+    return Client.cursor('task', query_data, projection=projection, sort=sort, limit=limit, bound=bound), limit
+
+
+def page_token(row, by_priority=False):
+    if by_priority:
+        return '{}:{}'.format(row.get('priority'), row.get('_id'))
+    return str(row.get('_id'))
+
+
+def usage_summary(by='user', depth=1, archived=False):
+    """
+    The resource usage of finished tasks summed per user, or per command prefix (the first `depth` words of cmd)
+    :param by: 'user' or 'cmd'
+    :param depth:
+    :param archived: include the task archive
+    :return: one row per user or prefix, heaviest cpu users first
+    """
+    try:
+        depth = int(depth)
+        assert by in ('user', 'cmd') and depth > 0
+    except (ValueError, AssertionError):
+        raise UserFault('by must be "user" or "cmd" and depth a positive integer')
+
+    group = {
+        '_id': '$user' if by == 'user' else {'$slice': ['$cmd', depth]},
+        'tasks': {'$sum': 1},
+        'max_rss_kb': {'$max': '$usage.max_rss_kb'},
+    }
+    for k in ('user_time', 'system_time', 'voluntary_switches', 'involuntary_switches', 'read_bytes', 'write_bytes'):
+        group[k] = {'$sum': '$usage.{}'.format(k)}
+
+    pipeline = [{'$unionWith': Task.ARCHIVE}] if archived else []
+    pipeline += [
+        {'$match': {'usage': {'$type': 'object'}}},
+        {'$group': group},
+        {'$addFields': {'cpu_time': {'$add': ['$user_time', '$system_time']}}},
+        {'$sort': {'cpu_time': -1}},
+    ]
+
+    rows = Client.aggregate('task', pipeline)
+    for row in rows:
+        row[by] = row.pop('_id')
+    return rows
+
+
 def from_id(_id):
     try:
         return Task.from_id(_id)
@@ -48,20 +181,273 @@ def from_id(_id):
         return None
 
 
-def get_next_queued():
-    doc = Client.next('task',
-                      query={'status': {'$in': config.runtime.task.states.queued}},
-                      sort_by='priority')
-    if doc:
-        t = Task(doc)
-        t.commit(status=Proc.FETCHED)
-        return t
-
-    return None
+def claim_queued(count):
+    # Array elements fill whatever slots the queued tasks leave
+    tasks = Task.claim_many(query={'status': {'$in': config.runtime.task.states.queued}},
+                            sort_by=Task.DISPATCH_SORT,
+                            update={'status': Proc.FETCHED, 'worker': worker_id, 'updated_at': now()},
+                            limit=count)
+    return tasks + lease_elements(count - len(tasks))
+
+
+def lease_elements(count, user=None):
+    """
+    Generate up to `count` elements of array tasks, highest priority array first. Each array hands out indexes
+    atomically -- handed back ones (array.retry) first, then the next ones -- so several runners can expand the same
+    array without overlap. Every lease is recorded with its worker until its elements report back
+    :param count:
+    :param user: only expand this user's arrays
+    :return: TaskElements
+    """
+    query = {'status': Task.ARRAY}
+    if user is not None:
+        query['user'] = user
+
+    elements = []
+    while len(elements) < count:
+        want = count - len(elements)
+        retry = {'$ifNull': ['$array.retry', []]}
+        fresh = {'$max': [{'$subtract': [want, {'$size': retry}]}, 0]}
+        stop = {'$min': [{'$add': ['$array.next', fresh]}, '$array.size']}
+        parent = Client.find_one_and_update('task', query, [{'$set': {
+            'array.next': stop,
+            'array.retry': {'$slice': [retry, want, {'$max': [{'$size': retry}, 1]}]},
+            'array.leases': {'$concatArrays': [
+                {'$filter': {'input': {'$ifNull': ['$array.leases', []]}, 'as': 'lease',
+                             'cond': {'$gt': [{'$size': '$$lease.pending'}, 0]}}},
+                [{'worker': worker_id, 'at': now(),
+                  'pending': {'$concatArrays': [{'$slice': [retry, want]}, {'$range': ['$array.next', stop]}]}}],
+            ]},
+            'status': {'$cond': [{'$and': [{'$lte': [{'$size': retry}, want]},
+                                           {'$gte': [{'$add': ['$array.next', fresh]}, '$array.size']}]},
+                                 Proc.PROCESSING, '$status']},
+            'start_time': {'$ifNull': ['$start_time', now()]},
+            'updated_at': now(),
+        }}], sort_by=Task.DISPATCH_SORT, projection={'array.params': 0, 'array.leases': 0, 'notes': 0},
+            after=False)
+        if not parent:
+            break
+
+        # The same indexes the update leased, worked out from the array as it was before it
+        retry = parent['array'].get('retry') or []
+        start = parent['array']['next']
+        stop = min(start + max(want - len(retry), 0), parent['array']['size'])
+        for i, param in element_params(parent, retry[:want] + list(range(start, stop))):
+            element = TaskElement.build(parent, i, param)
+            ensure_log_dir(element.log)
+            elements.append(element)
+    return elements
+
+
+def element_params(parent, indexes):
+    """
+    The range value or param of each leased index -- params is projected out of the parent, so only the runs of a
+    long parameter list that were leased are read back
+    :return: (index, param) pairs
+    """
+    if 'range' in parent['array']:
+        values = range(*parent['array']['range'])
+        return [(i, values[i]) for i in indexes]
+
+    runs = []
+    for i in sorted(indexes):
+        if runs and runs[-1][1] == i - 1:
+            runs[-1][1] = i
+        else:
+            runs.append([i, i])
+
+    params = {}
+    for first, last in runs:
+        rows = list(Client.cursor('task', {'_id': parent['_id']},
+                                  projection={'array.params': {'$slice': [first, last - first + 1]}}, limit=1))
+        params.update(zip(range(first, last + 1), rows[0]['array']['params'] if rows else []))
+    return [(i, params[i]) for i in indexes if i in params]
+
+
+def reclaim_leases(live):
+    """
+    Hand the unfinished elements leased by runners that are gone out again -- elements are never written, so unlike
+    tasks they cannot be adopted or re-queued
+    :param live: the workers whose leases stand
+    :return: number of arrays with elements handed back
+    """
+    gone = {'$filter': {'input': '$array.leases', 'as': 'lease',
+                        'cond': {'$not': [{'$in': ['$$lease.worker', live]}]}}}
+    return Client.update_many('task', {
+        'status': {'$in': [Task.ARRAY, Proc.PROCESSING]},
+        'array.leases': {'$elemMatch': {'worker': {'$nin': live}, 'pending.0': {'$exists': True}}},
+    }, [{'$set': {
+        'array.retry': {'$concatArrays': [
+            {'$ifNull': ['$array.retry', []]},
+            {'$reduce': {'input': gone, 'initialValue': [], 'in': {'$concatArrays': ['$$value', '$$this.pending']}}},
+        ]},
+        'array.leases': {'$filter': {'input': '$array.leases', 'as': 'lease', 'cond': {'$in': ['$$lease.worker', live]}}},
+        'array.counts.processing': {'$subtract': [
+            {'$ifNull': ['$array.counts.processing', 0]},
+            {'$sum': {'$map': {'input': gone, 'as': 'lease', 'in': {'$ifNull': ['$$lease.processing', 0]}}}},
+        ]},
+        'status': Task.ARRAY,
+        'updated_at': now(),
+    }}])
+
+
+def claim_fair(count, pool):
+    """
+    Claim the next `count` tasks in fair share order -- the pool's stride state splits the batch between the users
+    with queued tasks, then each user's share is claimed in priority order
+    :param count:
+    :param pool: the FairPool the claimed tasks go into
+    """
+    queued = {'status': {'$in': config.runtime.task.states.queued}}
+    claimed = []
+    users = Client.distinct('task', 'user', {'status': {'$in': config.runtime.task.states.queued + [Task.ARRAY]}})
+    for user, share in pool.plan(users, count).items():
+        tasks = Task.claim_many(query=dict(queued, user=user),
+                                sort_by=Task.DISPATCH_SORT,
+                                update={'status': Proc.FETCHED, 'worker': worker_id, 'updated_at': now()},
+                                limit=share)
+        claimed.extend(tasks + lease_elements(share - len(tasks), user=user))
+    return claimed
+
+
+def succeeded(row):
+    # An unknown outcome (Orphan.LOST) is not a success -- lost tasks fail their dependents
+    return row.get('status') == Proc.FINISHED and row.get('exit_code') == 0
+
+
+def dependency_states(ids):
+    """
+    Look up dependencies in the task collection, then the archive
+    :param ids: task ids as strings
+    :return: {id: True / False once the task succeeded / failed, None while it has not completed} -- unknown ids are
+    left out
+    """
+    found = {}
+    for collection_name in ('task', Task.ARCHIVE):
+        missing = [x for x in ids if x not in found]
+        if not missing:
+            break
+        for row in Client.cursor(collection_name, {'_id': {'$in': missing}}, projection=['status', 'exit_code']):
+            found[str(row['_id'])] = succeeded(row) if row.get('status') in states.complete else None
+    return found
+
+
+def release_dependents(dependency_id, ok):
+    """
+    Settle the tasks blocked on one completed task. Only that task's dependents are read, through the partial
+    depends_on index, so a completion costs O(out-degree). A failed dependency fails its dependents and theirs in turn
+    :param dependency_id:
+    :param ok: whether the dependency succeeded
+    :return: number of tasks released to the queue
+    """
+    released = 0
+    pending = [(str(dependency_id), ok)]
+    while pending:
+        dependency_id, ok = pending.pop()
+        children = [x['_id'] for x in Client.cursor('task', {'depends_on': dependency_id, 'status': Task.BLOCKED},
+                                                    projection=['_id'])]
+        if not children:
+            continue
+
+        blocked = {'_id': {'$in': children}, 'status': Task.BLOCKED}
+        if ok:
+            Client.update_many('task', blocked, {'$pull': {'waiting_on': dependency_id}})
+            for is_array, status in ((False, states.queued[0]), (True, Task.ARRAY)):
+                released += Client.update_many('task', dict(blocked, waiting_on={'$size': 0},
+                                                            array={'$ne': None} if is_array else None), {
+                    '$set': {'status': status, 'updated_at': now()},
+                    '$push': {'notes': {'text': 'dependencies complete', 'timestamp': now(), 'user': worker_id}},
+                })
+        else:
+            Client.update_many('task', blocked, {
+                '$set': {'status': Task.DEPENDENCY_FAILED, 'end_time': now(), 'updated_at': now()},
+                '$push': {'notes': {'text': 'dependency {} did not succeed'.format(dependency_id),
+                                    'timestamp': now(), 'user': worker_id}},
+            })
+            pending.extend((str(x), False) for x in children)
+    return released
+
+
+def settle_dependencies(tasks):
+    """
+    Release newly inserted blocked tasks whose dependencies completed before they were written -- read after the
+    insert, so a dependency completing in between is settled by one side or the other
+    :return: number of tasks released to the queue
+    """
+    ids = set(x for task in tasks if task.status == Task.BLOCKED for x in task.depends_on)
+    released = 0
+    for dependency_id, ok in dependency_states(ids).items():
+        if ok is not None:
+            released += release_dependents(dependency_id, ok)
+    return released
+
+
+def archive_complete(after, batch_size=500, pause=0.1):
+    """
+    Move complete tasks last updated more than `after` seconds ago into the archive collection, one batch at a time
+    so dispatch never waits behind a large move
+    :return: number of tasks archived
+    """
+    cutoff = now() - timedelta(seconds=after)
+    query_data = {'status': {'$in': config.runtime.task.states.complete}, 'updated_at': {'$lt': cutoff}}
+
+    archived = 0
+    while True:
+        moved = Client.move('task', Task.ARCHIVE, query_data, sort_by=[('_id', 1)], limit=batch_size)
+        archived += moved
+        if moved < batch_size:
+            return archived
+        sleep(pause)
+
+
+def check_dispatch_index():
+    """
+    Fail loudly when the dispatch query would scan the collection instead of walking the dispatch index
+    """
+    stages, index_names = Client.explain('task', {'status': {'$in': config.runtime.task.states.queued}},
+                                         sort_by=Task.DISPATCH_SORT)
+    if 'COLLSCAN' in stages or 'SORT' in stages or 'dispatch' not in index_names:
+        raise ApplicationFault('The dispatch query is not using the "dispatch" index -- plan: {}, indexes: {}'
+                               .format(' <- '.join(stages), ', '.join(index_names) or 'none'))
+    return True
+
+
+def heartbeat():
+    # Runners that stop writing this are presumed gone once worker_timeout passes
+    Client.update_one(WORKERS, {'_id': worker_id}, {'$set': {'heartbeat': now(), 'host': socket.gethostname()}},
+                      upsert=True)
+
+
+def live_workers(timeout=None):
+    cutoff = now() - timedelta(seconds=timeout or worker_timeout)
+    return Client.distinct(WORKERS, '_id', {'heartbeat': {'$gte': cutoff}})
+
+
+def reclaim_abandoned(timeout=None, startup=False):
+    """
+    Re-queue the in-progress tasks and hand back the array elements claimed by runners that stopped sending
+    heartbeats -- a runner that comes back under the same worker_id takes its own tasks over at startup instead
+    :param startup: this runner just started, so its own earlier leases are gone too
+    :return: number of tasks re-queued and arrays with elements handed back
+    """
+    live = live_workers(timeout)
+    leases = reclaim_leases([x for x in live if x != worker_id] if startup else live)
+    return leases + Client.update_many('task', {
+        'status': {'$in': config.runtime.task.states.in_progress},
+        'worker': {'$nin': live + [worker_id, None]},
+        'array': None,
+    }, {
+        '$set': {'status': states.queued[0], 'worker': None, 'updated_at': now()},
+        '$push': {'notes': {'text': 'its runner stopped sending heartbeats -- re-queued', 'timestamp': now(),
+                            'user': worker_id}},
+    })
 
 
 def startup_callback():
-    return [Task(x) for x in Client.find('task', {'status': {'$in': config.runtime.task.states.in_progress}})]
+    # Array parents stay in progress while their elements run -- they are never run themselves
+    return Task.hydrate(Client.find('task', {'status': {'$in': config.runtime.task.states.in_progress},
+                                             'worker': {'$in': [worker_id, None]},
+                                             'array': None}))
 
 
 _DEFUALT_FIELDS = (
@@ -69,6 +455,8 @@ _DEFUALT_FIELDS = (
     'env',
     'cwd',
     'pid',
+    'pid_start',
+    'boot_id',
     'init_time',
     'start_time',
     'end_time',
@@ -80,11 +468,21 @@ _DEFUALT_FIELDS = (
     'priority',
     'status',
     'timeout',
+    'cpus',
+    'memory_mb',
+    'pids_max',
+    'micro_batch',
+    'cgroup',
+    'usage',
+    'depends_on',
+    'waiting_on',
+    'array',
     'host',
     'user',
     'notes',
     'updated_at',
-    'parent_url'
+    'parent_url',
+    'worker'
 )
 
 
@@ -98,11 +496,39 @@ class Task(Document):
 
     _FORMATTABLE_FIELDS = _DEFAULT_FORMATTABLE_FIELDS + task_formattable_fields
 
+    SLIM_FIELDS = ('cmd', 'priority', 'status', 'host', 'parent_url', 'notes', 'user', 'exit_code', 'array.size',
+                   'array.next', 'array.done', 'array.failed', 'array.counts')
+    ARRAY_SUMMARY = ('size', 'next', 'done', 'failed', 'counts')
+    ELEMENT_FIELDS = ('cmd', 'log', 'env', 'cwd', 'stdin', 'timeout', 'cpus', 'memory_mb', 'pids_max', 'micro_batch',
+                      'priority', 'host', 'user', 'parent_url', 'init_time')
+    TIME_FIELDS = ('init_time', 'start_time', 'end_time', 'updated_at')
+
+    DISPATCH_SORT = [('priority', -1), ('_id', 1)]
+
+    ARCHIVE = 'task_archive'
+
+    BLOCKED = 'blocked'
+
+    ARRAY = 'array'
+
+    DEPENDENCY_FAILED = 'dependency-failed'
+
+    INDEXES = [
+        ([('status', 1), ('priority', -1), ('_id', 1)], {'name': 'dispatch'}),
+        ([('user', 1)], {'name': 'user'}),
+        ([('updated_at', -1)], {'name': 'updated_at'}),
+        ([('depends_on', 1)], {'name': 'depends_on', 'partialFilterExpression': {'status': 'blocked'}}),
+    ]
+
     __slots__ = _DEFUALT_FIELDS + task_extra_fields
 
     @staticmethod
-    def build(cmd, priority=100, log=config.runtime.task.log or '',
-              env=None, cwd=None, timeout=None, host=None, user='external_default', parent_url=''):
+    def prepare(cmd, priority=100, log=config.runtime.task.log or '',
+                env=None, cwd=None, timeout=None, cpus=1, memory_mb=0, pids_max=None, depends_on=None, array=None,
+                micro_batch=False, host=None, user='external_default', parent_url=''):
+        """
+        Validate a request and build its formatted Task in memory -- nothing is written
+        """
 
         assert isinstance(cmd, list), "The command argument must be a list"
         assert isinstance(priority, int), 'The priority argument should be an int'
@@ -112,37 +538,173 @@ class Task(Document):
             assert isinstance(env, dict), 'The env argument should be a dict'
         if cwd:
             assert isinstance(cwd, str), 'The cwd argument should be a string'
+        assert isinstance(cpus, (int, float)) and cpus > 0, 'The cpus argument should be a positive number'
+        assert isinstance(memory_mb, int) and memory_mb >= 0, 'The memory_mb argument should be a non-negative integer'
+        if pids_max:
+            assert isinstance(pids_max, int), 'The pids_max argument should be an integer'
+        if depends_on:
+            assert isinstance(depends_on, list), 'The depends_on argument should be a list of task ids'
+            depends_on = sorted(set(str(validate_object_id(x)) for x in depends_on))
+        if array:
+            array = Task.prepare_array(array)
+        assert isinstance(micro_batch, bool), 'The micro_batch argument should be a boolean'
 
         cmd = [str(x) for x in cmd]
 
         task = Task({
             'cmd': cmd,
             'log': log,
-            'init_time': timestamp(),
+            'init_time': now(),
             'priority': priority,
             'env': env,
             'cwd': cwd,
             'timeout': timeout,
+            'cpus': cpus,
+            'memory_mb': memory_mb,
+            'pids_max': pids_max,
+            'micro_batch': micro_batch or None,
+            'depends_on': depends_on or None,
+            'waiting_on': depends_on or None,
+            'array': array,
+            'status': Task.BLOCKED if depends_on else Task.ARRAY if array else None,
             'host': host,
             'user': user,
             'parent_url': parent_url,
             'notes': [
                 {
                     'text': 'task created',
-                    'timestamp': timestamp(),
+                    'timestamp': now(),
                     'user': user
                 }
             ]
         })
 
-        task.format_fields()
-        if task.log and not os.path.exists(os.path.dirname(task.log)):
-            os.makedirs(os.path.dirname(task.log))
+        if array:
+            # Arrays keep their templates -- each element is formatted as it is generated, try the first one now
+            try:
+                TaskElement.build(dict(task.dict, _id=''), 0, array['params'][0] if 'params' in array else
+                                  range(*array['range'])[0])
+            except (KeyError, IndexError, ValueError, TypeError, AttributeError) as e:
+                raise UserFault('The array template cannot be formatted: {!r}'.format(e))
+        else:
+            task.format_fields()
 
+        return task
+
+    @staticmethod
+    def prepare_array(array):
+        """
+        {"range": [start, stop, step]} or {"params": [value or {placeholder: value}, ...]} -- elements format {index}
+        and {param} into cmd and log, and a dict param's own keys too
+        """
+        assert isinstance(array, dict) and ('range' in array) != ('params' in array), \
+            'The array argument should be either {"range": [start, stop, step]} or {"params": [...]}'
+        if 'range' in array:
+            bounds = array['range']
+            assert isinstance(bounds, list) and 1 <= len(bounds) <= 3 and all(isinstance(x, int) for x in bounds), \
+                'An array range should be a list of 1 to 3 integers'
+            size = len(range(*bounds))
+            array = {'range': bounds}
+        else:
+            assert isinstance(array['params'], list), 'Array params should be a list'
+            size = len(array['params'])
+            array = {'params': array['params']}
+        assert size > 0, 'An array needs at least one element'
+
+        array.update({'size': size, 'next': 0, 'done': 0, 'failed': 0, 'counts': {}})
+        return array
+
+    @staticmethod
+    def build(cmd, *args, **kwargs):
+
+        task = Task.prepare(cmd, *args, **kwargs)
+        if task.depends_on:
+            unknown = set(task.depends_on) - set(dependency_states(task.depends_on))
+            if unknown:
+                raise UserFault('Unknown dependencies: {}'.format(', '.join(sorted(unknown))))
+        # An array's log is still a template -- each element creates its own directory when it is leased
+        if not task.array:
+            ensure_log_dir(task.log)
         task.commit()
+        settle_dependencies([task])
 
         return task
 
+    @staticmethod
+    def build_many(requests, status=None, ordered=False):
+        """
+        Validate and format every request in memory, then write them all with one insert_many
+        :param requests: list of Task.build keyword dicts
+        :param status:
+        :param ordered: stop at the first failed write instead of inserting everything that can be
+        :return: (inserted tasks, [{'index': i, 'message': str}, ...] for every request that was not inserted)
+        """
+        prepared = []
+        indexes = []
+        errors = []
+        for index, req in enumerate(requests):
+            try:
+                assert isinstance(req, dict), "Each request must be a dict -- " \
+                                              "this was what was received: req = '{}', type = '{}'".format(req,
+                                                                                                         type(req))
+                prepared.append(Task.prepare(**req))
+                indexes.append(index)
+            except (UserFault, AssertionError, TypeError, ValueError, KeyError, AttributeError) as e:
+                errors.append({'index': index, 'message': str(e)})
+
+        # Every dependency has to exist already -- looked up once for the whole batch
+        known = dependency_states(set(x for task in prepared for x in task.depends_on or []))
+        for i in reversed(range(len(prepared))):
+            unknown = set(prepared[i].depends_on or []) - set(known)
+            if unknown:
+                errors.append({'index': indexes[i], 'message': 'Unknown dependencies: {}'.format(
+                    ', '.join(sorted(unknown)))})
+                del prepared[i]
+                del indexes[i]
+
+        for task in prepared:
+            if not task.array:
+                ensure_log_dir(task.log)
+
+        failed = dict(Task.insert_many(prepared, status=status, ordered=ordered))
+        errors.extend({'index': indexes[i], 'message': failed[i]} for i in sorted(failed))
+        errors.sort(key=lambda x: x['index'])
+
+        inserted = [task for i, task in enumerate(prepared) if i not in failed]
+        settle_dependencies(inserted)
+        return inserted, errors
+
+    @classmethod
+    def from_id(cls, object_id):
+        # Archived tasks keep their ids, so old task urls fall through to the archive
+        task = super(Task, cls).from_id(object_id)
+        if task:
+            return task
+
+        document = Client.find_one(Task.ARCHIVE, {'_id': validate_object_id(object_id)})
+        if not document:
+            return task
+        return cls.hydrate([document])[0]
+
+    @classmethod
+    def bulk_update(cls, updates, extra=None):
+        stamp = {'updated_at': now()}
+        stamp.update(extra or {})
+        return super(Task, cls).bulk_update(updates, extra=stamp)
+
+    @classmethod
+    def update_where(cls, where, fields, extra=None):
+        # Filtering on a state group, e.g. {"state": "queued"}, matches every status in that group
+        where = dict(where) if isinstance(where, dict) else where
+        if isinstance(where, dict) and 'state' in where:
+            state = where.pop('state')
+            if not getattr(states, str(state)):
+                raise UserFault('State "{}" not found -- available states: {}'.format(state, ', '.join(states.keys)))
+            where['status'] = getattr(states, state)
+        stamp = {'updated_at': now()}
+        stamp.update(extra or {})
+        return super(Task, cls).update_where(where, fields, extra=stamp)
+
     @staticmethod
     def str_convert(s, codec='utf-8'):
         try:
@@ -171,7 +733,7 @@ class Task(Document):
     def __eq__(self, other):
         return self.priority == other.priority
 
-    def format_fields(self):
+    def format_fields(self, **extra):
 
         format_dict = {
             'name': self.name or hexify(),
@@ -179,6 +741,7 @@ class Task(Document):
         }
 
         format_dict.update(self.dict)
+        format_dict.update(extra)
 
         for att in Task._FORMATTABLE_FIELDS:
 
@@ -199,42 +762,186 @@ class Task(Document):
         assert isinstance(note, str), "A note must be a string"
         note = {
             'text': note,
-            'timestamp': timestamp(),
+            'timestamp': now(),
             'user': user
         }
-        if not self.notes:
-            self.notes = []
-        self.notes.append(note)
+        self.push('notes', note)
+
+    @classmethod
+    def serialize(cls, row, full=False):
+        """
+        The slim or full view of a raw task row -- lets listings skip building Task objects
+        :param row:
+        :param full:
+        :return:
+        """
+        url = '{}proc_pool/task/{}'.format(row.get('host'), row.get('_id'))
+        notes = [
+            dict(note, timestamp=format_time(note.get('timestamp'))) for note in row.get('notes') or []
+        ]
+        if full:
+            tmp = {k: row.get(k) for k in cls.__slots__}
+            tmp.update({k: format_time(tmp[k]) for k in cls.TIME_FIELDS})
+            if tmp.get('array') and tmp['array'].get('leases'):
+                tmp['array'] = dict(tmp['array'], leases=[
+                    dict(lease, at=format_time(lease.get('at'))) for lease in tmp['array']['leases']
+                ])
+            tmp.update({
+                'id': str(row.get('_id')),
+                'url': url,
+                'notes': notes,
+            })
+            return tmp
+
+        return {
+            'id': str(row.get('_id')),
+            'cmd': row.get('cmd'),
+            'priority': row.get('priority'),
+            'status': row.get('status'),
+            'url': url,
+            'parent_url': row.get('parent_url'),
+            'notes': notes,
+            'user': row.get('user'),
+            'exit_code': row.get('exit_code'),
+            'array': {k: row['array'].get(k) for k in cls.ARRAY_SUMMARY} if row.get('array') else None,
+        }
 
     @property
-    def full(self):
-        tmp = super(Task, self).full
-        tmp.update({
-            'url': self.url,
-            'parent_url': self.parent_url
-        })
+    def row(self):
+        tmp = self.dict
+        tmp['_id'] = self._id
         return tmp
 
+    @property
+    def full(self):
+        return Task.serialize(self.row, full=True)
+
     @property
     def url(self):
         return '{}proc_pool/task/{}'.format(self.host, self.name)
 
     @property
     def slim(self):
-        return {
-            'id': self.name,
-            'cmd': self.cmd,
-            'priority': self.priority,
-            'status': self.status,
-            'url': self.url,
-            'parent_url': self.parent_url,
-            'notes': self.notes,
-            'user': self.user,
-            'exit_code': self.exit_code
-        }
+        return Task.serialize(self.row)
 
     def commit(self, status=None, note=None, user='internal_default'):
-        self.updated_at = timestamp()
+        self.updated_at = now()
         if note:
             self.add_note(note=note, user=user)
         super(Task, self).commit(status=status)
+
+    @classmethod
+    def commit_many(cls, tasks):
+        for task in tasks:
+            task.updated_at = now()
+        return super(Task, cls).commit_many(tasks)
+
+
+class TaskElement(Task):
+    """
+    One generated element of an array task -- it lives only in the runner and reports to its parent's counters
+    instead of being written itself. No __slots__ of its own so Document.dict keeps using Task's
+    """
+
+    FAILURES_KEPT = 100
+
+    # Whether starting the element was counted as processing on the parent -- micro batches and spawns that fail
+    # never are
+    counted = False
+
+    @classmethod
+    def build(cls, parent, index, param):
+        """
+        :param parent: the array task's row
+        :param index: the element's position in the array
+        :param param: its value from the range or params list
+        :return:
+        """
+        element = cls({k: parent.get(k) for k in Task.ELEMENT_FIELDS}, _id='{}.{}'.format(parent['_id'], index))
+        element.status = Proc.FETCHED
+        element.worker = worker_id
+
+        extra = dict(param) if isinstance(param, dict) else {}
+        extra.update({'index': index, 'param': param})
+        element.format_fields(**extra)
+        element.clean()
+        return element
+
+    @property
+    def parent_id(self):
+        return validate_object_id(self._id.rsplit('.', 1)[0])
+
+    @property
+    def index(self):
+        return int(self._id.rsplit('.', 1)[1])
+
+    def commit(self, status=None, note=None, user='internal_default'):
+        """
+        Report to the parent through the lease holding the element -- once its lease was taken back from this runner,
+        the element is counted by whichever runner has it now
+        """
+        if status:
+            self.status = status
+        self.updated_at = now()
+        self.clean()
+
+        lease = {'_id': self.parent_id, 'array.leases.pending': self.index}
+        if self.status == Proc.PROCESSING:
+            # Counted on the lease too, so taking the lease back settles what its runner left processing
+            self.counted = bool(Client.find_one_and_update('task', lease, {
+                '$inc': {'array.counts.processing': 1, 'array.leases.$.processing': 1},
+            }, projection={'_id': 1}))
+            return True
+        if self.status not in states.complete:
+            return True
+
+        ok = succeeded(self.row)
+        action = {'$inc': {'array.counts.{}'.format(self.status): 1, 'array.done': 1}}
+        if self.counted:
+            action['$inc']['array.counts.processing'] = -1
+            action['$inc']['array.leases.$.processing'] = -1
+        if not ok:
+            action['$inc']['array.failed'] = 1
+            action['$push'] = {'array.failures': {'$each': [{
+                'index': self.index,
+                'status': self.status,
+                'exit_code': self.exit_code,
+                'stderr': self.stderr[-1024:] if self.stderr else None,
+            }], '$slice': -TaskElement.FAILURES_KEPT}}
+        # Off its lease, so the element is not handed out again if this runner goes away
+        action['$pull'] = {'array.leases.$.pending': self.index}
+        parent = Client.find_one_and_update('task', lease, action,
+                                            projection=['array.size', 'array.done', 'array.failed'])
+
+        # Exactly one element sees the last increment -- it completes the parent
+        if parent and parent['array']['done'] == parent['array']['size']:
+            ok = not parent['array']['failed']
+            Client.update_one('task', {'_id': self.parent_id}, {
+                '$set': {'status': Proc.FINISHED if ok else Proc.ERRORED, 'exit_code': 0 if ok else 1,
+                         'end_time': now(), 'updated_at': now()},
+                '$unset': {'array.leases': '', 'array.retry': ''},
+                '$push': {'notes': {'text': 'array complete -- {} of {} failed'.format(parent['array']['failed'],
+                                                                                     parent['array']['size']),
+                                    'timestamp': now(), 'user': user}},
+            })
+            if release_dependents(self.parent_id, ok):
+                notify_runner()
+        return True
+
+    @classmethod
+    def commit_many(cls, tasks):
+        # Elements only ever touch their parent's counters
+        for task in tasks:
+            task.commit()
+        return len(tasks)
+
+
+__INDEXES = {'task': list(Task.INDEXES)}
+if fair_share and fair_share.enabled:
+    __INDEXES['task'].append(([('status', 1), ('user', 1), ('priority', -1), ('_id', 1)], {'name': 'fair_dispatch'}))
+if archive and archive.expire_after:
+    __INDEXES[Task.ARCHIVE] = [
+        ([('updated_at', 1)], {'name': 'expire', 'expireAfterSeconds': int(archive.expire_after)})
+    ]
+
+Client.set(config.startup.db.url, config.startup.db.name, indexes=__INDEXES)
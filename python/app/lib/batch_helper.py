@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# The long-lived side of a micro batch: started once per batch in the batch's cwd and env, it runs the commands the
+# runner writes to its stdin back to back and answers each one with a line of results
+# usage: batch_helper.py [tail size] [timeout grace]
+
+import os
+import sys
+import json
+from time import time
+from select import select
+from signal import SIGTERM, SIGKILL
+from tempfile import TemporaryFile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from manager import usage_of
+
+
+def wait(pid, timeout=None, grace=10):
+    """
+    wait4 the child, sending its process group SIGTERM once the timeout passes and SIGKILL after the grace
+    :return: (wait status, rusage, whether it timed out)
+    """
+    timed_out = False
+    if timeout:
+        pidfd = os.pidfd_open(pid)
+        try:
+            for sig, delay in ((SIGTERM, timeout), (SIGKILL, grace)):
+                if select([pidfd], [], [], delay)[0]:
+                    break
+                timed_out = True
+                try:
+                    os.killpg(pid, sig)
+                except OSError:
+                    pass
+        finally:
+            os.close(pidfd)
+
+    _, status, rusage = os.wait4(pid, 0)
+    return status, rusage, timed_out
+
+
+def run(request, stderr, tail_size=65536, grace=10):
+    # stdout goes straight to the task's log, stderr is kept aside for the tail and appended to the log afterwards
+    log = os.open(request.get('log') or os.devnull, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        started = time()
+        try:
+            pid = os.posix_spawnp(request['cmd'][0], request['cmd'], os.environ, setsid=True, file_actions=[
+                (os.POSIX_SPAWN_OPEN, 0, os.devnull, os.O_RDONLY, 0),
+                (os.POSIX_SPAWN_DUP2, log, 1),
+                (os.POSIX_SPAWN_DUP2, stderr.fileno(), 2),
+            ])
+        except (OSError, IndexError) as e:
+            return {'error': str(e), 'start': started, 'end': time()}
+
+        status, rusage, timed_out = wait(pid, request.get('timeout'), grace)
+        ended = time()
+
+        stderr.seek(0)
+        err = stderr.read()
+        stderr.seek(0)
+        stderr.truncate()
+        if err:
+            os.write(log, err)
+    finally:
+        os.close(log)
+
+    return {
+        'pid': pid,
+        'exit_code': os.waitstatus_to_exitcode(status),
+        'usage': usage_of(rusage),
+        'stderr': err[-tail_size:].decode('utf-8', 'replace'),
+        'timed_out': timed_out,
+        'start': started,
+        'end': ended,
+    }
+
+
+def main(tail_size=65536, grace=10):
+    with TemporaryFile() as stderr:
+        for line in sys.stdin:
+            sys.stdout.write(json.dumps(run(json.loads(line), stderr, tail_size, grace)) + '\n')
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:3]])
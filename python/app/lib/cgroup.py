@@ -0,0 +1,164 @@
+import os
+from time import sleep
+
+
+MB = 1024 * 1024
+
+
+class CGroup(object):
+    """
+    One task's cgroup v2 group -- limits are written before the child starts and the child joins the group before exec
+    """
+
+    __slots__ = (
+        'path',
+        '__procs',
+    )
+
+    def __init__(self, path, cpu_max=None, memory_max=None, pids_max=None, create=True):
+        self.path = path
+        self.__procs = None
+
+        if not create:
+            return
+
+        os.mkdir(path)
+        for name, value in (('cpu.max', cpu_max), ('memory.max', memory_max), ('pids.max', pids_max)):
+            if value is not None:
+                self.write(name, value)
+        self.__procs = os.open(os.path.join(path, 'cgroup.procs'), os.O_WRONLY)
+
+    def enter(self):
+        # Runs in the forked child before exec -- one raw write, nothing that could wait on a lock held by another thread
+        os.write(self.__procs, b'0')
+
+    def fileno(self):
+        # For a spawner in another process to join the group through
+        return self.__procs
+
+    def close(self):
+        if self.__procs is not None:
+            os.close(self.__procs)
+            self.__procs = None
+
+    def write(self, name, value):
+        with open(os.path.join(self.path, name), 'w') as f:
+            f.write(str(value))
+
+    def read(self, name):
+        """
+        A flat keyed stats file (cpu.stat, memory.events) as a dict, a single value file as an int
+        :return: None when the kernel does not have the file
+        """
+        try:
+            with open(os.path.join(self.path, name)) as f:
+                lines = f.read().split('\n')
+        except (OSError, IOError):
+            return None
+
+        pairs = [line.split() for line in lines if line]
+        if len(pairs) == 1 and len(pairs[0]) == 1:
+            return int(pairs[0][0]) if pairs[0][0].isdigit() else pairs[0][0]
+        return {k: int(v) for k, v in pairs}
+
+    @property
+    def stats(self):
+        cpu = self.read('cpu.stat') or {}
+        events = self.read('memory.events') or {}
+        return {
+            'path': self.path,
+            'memory_peak': self.read('memory.peak'),
+            'cpu_usec': cpu.get('usage_usec'),
+            'user_usec': cpu.get('user_usec'),
+            'system_usec': cpu.get('system_usec'),
+            'oom_kills': events.get('oom_kill', 0),
+        }
+
+    def remove(self, attempts=20):
+        """
+        Kill whatever the task left behind in the group and remove it -- a group that will not empty is left for
+        CGroupTree.setup to prune
+        """
+        self.close()
+        try:
+            self.write('cgroup.kill', 1)
+        except (OSError, IOError):
+            pass
+
+        for _ in range(attempts):
+            try:
+                os.rmdir(self.path)
+                return True
+            except FileNotFoundError:
+                return True
+            except OSError:
+                sleep(0.01)
+        return False
+
+
+class CGroupTree(object):
+    """
+    The runner's delegated cgroup v2 subtree -- the runner moves itself into <root>/runner so the controllers can be
+    enabled for one sibling group per task
+    """
+
+    CONTROLLERS = ('cpu', 'memory', 'pids')
+
+    __slots__ = (
+        'root',
+        'memory_max_mb',
+        'pids_max',
+        'cpu_period',
+    )
+
+    def __init__(self, root, memory_max_mb=None, pids_max=None, cpu_period=100000):
+        assert root, 'The cgroup tree needs a root directory inside a cgroup v2 mount'
+
+        self.root = root
+        self.memory_max_mb = memory_max_mb
+        self.pids_max = pids_max
+        self.cpu_period = cpu_period
+
+    def setup(self):
+        controllers = ' '.join('+{}'.format(x) for x in CGroupTree.CONTROLLERS)
+        runner = os.path.join(self.root, 'runner')
+        if not os.path.isdir(runner):
+            os.makedirs(runner)
+
+        # cgroup v2 only hands controllers to groups whose parent holds no processes of its own
+        with open(os.path.join(runner, 'cgroup.procs'), 'w') as f:
+            f.write(str(os.getpid()))
+        for path in (os.path.dirname(self.root.rstrip('/')), self.root):
+            with open(os.path.join(path, 'cgroup.subtree_control'), 'w') as f:
+                f.write(controllers)
+
+        # Groups of tasks that ended while the runner was down -- the ones still holding adopted children stay
+        for name in os.listdir(self.root):
+            if name.startswith('task-'):
+                try:
+                    os.rmdir(os.path.join(self.root, name))
+                except OSError:
+                    pass
+
+    def path(self, task):
+        return os.path.join(self.root, 'task-{}'.format(task._id))
+
+    def create(self, task):
+        """
+        A fresh group limited by the task's cpus, memory_mb and pids_max, falling back to the configured defaults
+        """
+        path = self.path(task)
+        if os.path.isdir(path):
+            CGroup(path, create=False).remove()
+
+        memory_mb = task.memory_mb or self.memory_max_mb
+        return CGroup(path,
+                      cpu_max='{} {}'.format(int(task.cpus * self.cpu_period), self.cpu_period) if task.cpus else None,
+                      memory_max=memory_mb * MB if memory_mb else None,
+                      pids_max=task.pids_max or self.pids_max)
+
+    def attach(self, task):
+        # The group an adopted child is already running in, if it is still there
+        path = self.path(task)
+        if os.path.isdir(path):
+            return CGroup(path, create=False)
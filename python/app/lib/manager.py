@@ -1,12 +1,21 @@
+import os
+import sys
+import json
+import socket
+import logging
 from uuid import uuid4
-from time import sleep
+from select import PIPE_BUF
+from select import select
+from selectors import DefaultSelector, EVENT_READ, EVENT_WRITE
+from time import time, sleep
+from itertools import count
 from datetime import datetime
 from subprocess import Popen, PIPE  # TimeoutExpired -- not available in py2
 from collections import namedtuple
-from signal import SIGSTOP, SIGCONT
-from heapq import heappush, heappop
+from signal import SIGSTOP, SIGCONT, SIGTERM, SIGKILL
+from heapq import heappush, heappop, heapify
 from functools import partial
-from threading import Thread, Condition
+from threading import Thread, Condition, Lock, Event as _Event
 try:
     from Queue import Queue
 except ImportError:
@@ -15,6 +24,9 @@ except ImportError:
 
 TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 
+# The runner's logger -- proc_run.py gives it its handler
+LOGGER = logging.getLogger('proc_run')
+
 
 def hexify(): return uuid4().hex
 
@@ -23,12 +35,309 @@ def timestamp(time_format=TIME_FORMAT):
     return datetime.now().strftime(time_format)
 
 
+def now():
+    # Naive UTC truncated to milliseconds -- exactly what a BSON datetime stores and reads back
+    t = datetime.utcnow()
+    return t.replace(microsecond=t.microsecond // 1000 * 1000)
+
+
+def from_epoch(seconds):
+    t = datetime.utcfromtimestamp(seconds)
+    return t.replace(microsecond=t.microsecond // 1000 * 1000)
+
+
+def format_time(value, time_format=TIME_FORMAT):
+    if isinstance(value, datetime):
+        return value.strftime(time_format)
+    return value
+
+
+def read_boot_id():
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            return f.read().strip()
+    except (OSError, IOError):
+        return None
+
+
+BOOT_ID = read_boot_id()
+
+
+def process_start(pid):
+    """
+    The kernel's start time (clock ticks after boot) of a live pid, which tells a still running child apart from an
+    unrelated process that reused its pid
+    :param pid:
+    :return: None once the pid has exited
+    """
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            stat = f.read()
+    except (OSError, IOError):
+        return None
+    # comm can hold spaces and parens -- the fields after it start with the state, starttime is the 20th
+    fields = stat[stat.rindex(')') + 2:].split()
+    if fields[0] in ('Z', 'X'):
+        return None
+    return int(fields[19])
+
+
+def usage_of(rusage):
+    # Block counts from wait4 are in 512 byte units
+    return {
+        'user_time': rusage.ru_utime,
+        'system_time': rusage.ru_stime,
+        'max_rss_kb': rusage.ru_maxrss,
+        'voluntary_switches': rusage.ru_nvcsw,
+        'involuntary_switches': rusage.ru_nivcsw,
+        'read_bytes': rusage.ru_inblock * 512,
+        'write_bytes': rusage.ru_oublock * 512,
+    }
+
+
 Event = namedtuple('Event', 'artifact')
 
 
 Artifact = namedtuple('Artifact', 'status parent_url to_delete')
 
 
+class OutputTail(object):
+    """
+    Keeps only the last `size` bytes written to it
+    """
+
+    __slots__ = (
+        'size',
+        'buffer',
+    )
+
+    def __init__(self, size):
+        self.size = size
+        self.buffer = bytearray()
+
+    def write(self, chunk):
+        self.buffer += chunk
+        if len(self.buffer) > self.size:
+            del self.buffer[:len(self.buffer) - self.size]
+
+    @property
+    def text(self):
+        return self.buffer.decode('utf-8', 'replace')
+
+
+class Orphan(object):
+    """
+    Popen-alike handle on a child started by an earlier runner -- it is not our child, so its exit is seen through a
+    pidfd or by polling /proc and its exit code is lost
+    """
+
+    LOST = -9999
+
+    __slots__ = (
+        'pid',
+        'started',
+        'returncode',
+        'stdin',
+        'stdout',
+        'stderr',
+    )
+
+    def __init__(self, pid, started):
+        self.pid = pid
+        self.started = started
+        self.returncode = None
+        self.stdin = None
+        self.stdout = None
+        self.stderr = None
+
+    def poll(self):
+        if self.returncode is None and process_start(self.pid) != self.started:
+            self.returncode = Orphan.LOST
+        return self.returncode
+
+    def wait(self, poll_interval=0.5):
+        try:
+            pidfd = os.pidfd_open(self.pid)
+        except (AttributeError, OSError):
+            pidfd = None
+
+        try:
+            while self.poll() is None:
+                if pidfd is None:
+                    sleep(poll_interval)
+                else:
+                    select([pidfd], [], [], poll_interval)
+        finally:
+            if pidfd is not None:
+                os.close(pidfd)
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.poll() is None:
+            os.kill(self.pid, sig)
+
+    def terminate(self):
+        self.send_signal(SIGTERM)
+
+    def kill(self):
+        self.send_signal(SIGKILL)
+
+
+class Zygote(object):
+    """
+    Client side of lib/zygote.py -- a spawn server started while the runner is small. Spawn requests go one at a time
+    over a SOCK_SEQPACKET pair with the child's pipe ends attached and are answered on it; exits come back on a second
+    pair and are kept by pid until the child's handle collects them
+    """
+
+    SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'zygote.py')
+
+    __slots__ = (
+        'proc',
+        'requests',
+        'exits_socket',
+        'alive',
+        'exits',
+        'waiters',
+        'request_lock',
+        'lock',
+    )
+
+    def __init__(self):
+        assert hasattr(socket, 'send_fds'), 'The zygote spawner needs python 3.9 or later'
+
+        self.requests, requests = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.exits_socket, exits = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.proc = Popen([sys.executable, Zygote.SERVER, str(requests.fileno()), str(exits.fileno())],
+                          pass_fds=[requests.fileno(), exits.fileno()], close_fds=True)
+        requests.close()
+        exits.close()
+
+        self.alive = True
+        self.exits = {}
+        self.waiters = {}
+        self.request_lock = Lock()
+        self.lock = Lock()
+
+        t = Thread(target=self.__listen)
+        t.daemon = True
+        t.start()
+        del t
+
+    def __listen(self):
+        while True:
+            try:
+                message = self.exits_socket.recv(1 << 16)
+            except OSError:
+                message = b''
+            if not message:
+                break
+            message = json.loads(message.decode('utf-8'))
+            with self.lock:
+                self.exits[message['exit']] = (message['code'], message['usage'])
+                waiter = self.waiters.get(message['exit'])
+            # Only the child's own waiter wakes up, not every thread parked on a child
+            if waiter is not None:
+                waiter.set()
+
+        # Children of a dead zygote are nobody's to wait for -- their handles fall back to watching /proc
+        with self.lock:
+            self.alive = False
+            waiters = list(self.waiters.values())
+        for waiter in waiters:
+            waiter.set()
+
+    def spawn(self, cmd, cwd=None, env=None, fds=()):
+        """
+        :param fds: the child's stdin, stdout and stderr, then optionally a cgroup.procs fd to join before exec
+        :return: a ZygoteChild, raises OSError like Popen when the command could not be started
+        """
+        request = json.dumps({'cmd': cmd, 'cwd': cwd, 'env': env}).encode('utf-8')
+        with self.request_lock:
+            if not self.alive:
+                raise OSError('the zygote exited')
+            socket.send_fds(self.requests, [request], list(fds))
+            reply = self.requests.recv(1 << 16)
+        if not reply:
+            raise OSError('the zygote exited')
+
+        reply = json.loads(reply.decode('utf-8'))
+        if 'pid' not in reply:
+            if reply.get('errno') is None:
+                raise OSError(reply.get('error'))
+            raise OSError(reply['errno'], reply.get('error'), reply.get('filename'))
+        return ZygoteChild(reply['pid'], self)
+
+    def collect(self, pid, timeout=None):
+        """
+        :return: (exit code, usage) once the zygote reported the exit, else None
+        """
+        with self.lock:
+            if pid in self.exits or not self.alive:
+                self.waiters.pop(pid, None)
+                return self.exits.pop(pid, None)
+            waiter = self.waiters.setdefault(pid, _Event())
+
+        waiter.wait(timeout)
+        with self.lock:
+            result = self.exits.pop(pid, None)
+            if result is not None or not self.alive:
+                self.waiters.pop(pid, None)
+        return result
+
+
+class ZygoteChild(object):
+    """
+    Popen-alike handle on a child the zygote started -- the pipes are set by Proc, the exit code and usage come from
+    the zygote
+    """
+
+    __slots__ = (
+        'pid',
+        'zygote',
+        'started',
+        'returncode',
+        'usage',
+        'stdin',
+        'stdout',
+        'stderr',
+    )
+
+    def __init__(self, pid, zygote):
+        self.pid = pid
+        self.zygote = zygote
+        self.started = process_start(pid)
+        self.returncode = None
+        self.usage = None
+        self.stdin = None
+        self.stdout = None
+        self.stderr = None
+
+    def __settle(self, result):
+        if result is not None:
+            self.returncode, self.usage = result
+        elif not self.zygote.alive:
+            # Reaped by init now -- gone or its pid reused, its exit code is lost like an orphan's
+            current = process_start(self.pid)
+            if current is None or current != self.started:
+                self.returncode = Orphan.LOST
+        return self.returncode
+
+    def poll(self):
+        if self.returncode is not None:
+            return self.returncode
+        # Once the child has exited the zygote's report is only moments away
+        if process_start(self.pid) is None:
+            return self.wait()
+        return self.__settle(self.zygote.collect(self.pid, timeout=0))
+
+    def wait(self, poll_interval=0.5):
+        while self.returncode is None:
+            if self.__settle(self.zygote.collect(self.pid)) is None and not self.zygote.alive:
+                sleep(poll_interval)
+        return self.returncode
+
+
 class Proc(object):
 
     FINISHED = 'finished'
@@ -36,15 +345,30 @@ class Proc(object):
     ERRORED = 'errored'
     PROCESSING = 'processing'
     FETCHED = 'fetched'
+    OOMKILLED = 'oom-killed'
+    LOST = 'lost'
 
     __slots__ = (
         'task',
         'callback',
         'proc',
         'suspended',
+        'timed_out',
+        'deadline',
+        'log_handle',
+        'stdout_tail',
+        'stderr_tail',
+        'sinks',
+        'stdin_pending',
+        'adopted',
+        'cgroups',
+        'cgroup',
+        'usage',
+        'reap_lock',
+        'zygote',
     )
 
-    def __init__(self, task):
+    def __init__(self, task, tail_size=65536, cgroups=None, zygote=None):
 
         self.task = task
         self.callback = partial(Popen,
@@ -53,9 +377,23 @@ class Proc(object):
                                 stderr=PIPE,
                                 cwd=task.cwd,
                                 env=task.env,
-                                close_fds=True)
+                                close_fds=True,
+                                start_new_session=True)
         self.proc = None
         self.suspended = False
+        self.timed_out = False
+        self.deadline = None
+        self.log_handle = None
+        self.stdout_tail = None
+        self.stderr_tail = OutputTail(tail_size)
+        self.sinks = {}
+        self.stdin_pending = None
+        self.adopted = False
+        self.cgroups = cgroups
+        self.cgroup = None
+        self.usage = None
+        self.reap_lock = Lock()
+        self.zygote = zygote
 
     def __repr__(self):
         return str(self.callback)
@@ -64,34 +402,259 @@ class Proc(object):
         return str(self.callback)
 
     def run(self, log=True):
-        log_handle = open(self.task.log, 'ab') if (log and self.task.log) else PIPE
-        status = Proc.PROCESSING
         try:
-            self.proc = self.callback(stdout=log_handle)
+            if not self.adopted:
+                self.start(log=log)
+                self.stream()
+            self.reap()
+        except (OSError, IOError) as e:
+            return self.fail(e)
+
+        self.finish(Proc.FINISHED)
+
+    def start(self, log=True):
+        # Unbuffered so stderr chunks written by the runner interleave with the child's own stdout writes
+        if log and self.task.log:
+            self.log_handle = open(self.task.log, 'ab', 0)
+        else:
+            self.stdout_tail = OutputTail(self.stderr_tail.size)
+
+        if self.cgroups:
+            self.cgroup = self.cgroups.create(self.task)
+            self.task.cgroup = {'path': self.cgroup.path}
+            try:
+                self.proc = self.spawn()
+            finally:
+                self.cgroup.close()
+        else:
+            self.proc = self.spawn()
+
+        self.sinks = {}
+        if self.proc.stderr:
+            self.sinks[self.proc.stderr] = (self.stderr_tail, self.log_handle)
+        if self.stdout_tail:
+            self.sinks[self.proc.stdout] = (self.stdout_tail, None)
+
+        self.stdin_pending = memoryview(self.stdin_bytes())
+        if not self.stdin_pending:
+            self.proc.stdin.close()
+
+        self.task.pid = self.proc.pid
+        self.task.pid_start = process_start(self.proc.pid)
+        self.task.boot_id = BOOT_ID
+        self.task.start_time = now()
+        self.task.commit(status=Proc.PROCESSING, note='task started')
+
+    def spawn(self):
+        # A child with a log writes its stderr to a file next to it, not to a pipe -- a pipe would kill it with
+        # SIGPIPE once the runner is gone, and an adopted child has to keep running
+        stderr = open(self.stderr_path, 'ab', 0) if self.log_handle else None
+        try:
+            if self.zygote is None:
+                if self.cgroup:
+                    return self.callback(stdout=self.log_handle or PIPE, stderr=stderr or PIPE,
+                                         preexec_fn=self.cgroup.enter)
+                return self.callback(stdout=self.log_handle or PIPE, stderr=stderr or PIPE)
+            return self.__spawn_zygote(stderr)
+        finally:
+            if stderr:
+                stderr.close()
+
+    def __spawn_zygote(self, stderr):
+        # The zygote gets the child's ends of the pipes, the runner keeps the other ends like Popen would
+        stdin_read, stdin_write = os.pipe()
+        stderr_read, stderr_write = (None, None) if stderr else os.pipe()
+        stdout_read, stdout_write = (None, None) if self.log_handle else os.pipe()
+        fds = [stdin_read, self.log_handle.fileno() if self.log_handle else stdout_write,
+               stderr.fileno() if stderr else stderr_write]
+        if self.cgroup:
+            fds.append(self.cgroup.fileno())
+        try:
+            child = self.zygote.spawn(self.task.cmd, cwd=self.task.cwd, env=self.task.env, fds=fds)
+        except (OSError, IOError):
+            for fd in (stdin_write, stderr_read, stdout_read):
+                if fd is not None:
+                    os.close(fd)
+            raise
+        finally:
+            for fd in (stdin_read, stderr_write, stdout_write):
+                if fd is not None:
+                    os.close(fd)
+
+        child.stdin = open(stdin_write, 'wb', 0)
+        child.stderr = open(stderr_read, 'rb', 0) if stderr_read is not None else None
+        child.stdout = open(stdout_read, 'rb', 0) if stdout_read is not None else None
+        return child
 
-            self.task.pid = self.proc.pid
-            self.task.start_time = timestamp()
-            self.task.commit(status=status, note='task started')
+    @property
+    def stderr_path(self):
+        return '{}.err'.format(self.task.log) if self.task.log else None
+
+    def collect_stderr(self):
+        """
+        Move the stderr file onto the end of the log, keeping its tail for the task
+        """
+        path = self.stderr_path
+        if not path or not os.path.exists(path):
+            return
+        try:
+            with open(path, 'rb') as err, open(self.task.log, 'ab') as log:
+                for chunk in iter(lambda: err.read(65536), b''):
+                    self.stderr_tail.write(chunk)
+                    log.write(chunk)
+            os.remove(path)
+        except (OSError, IOError):
+            pass
 
-            self.task.stdout, self.task.stderr = self.proc.communicate(input=self.task.stdin)
-            status = Proc.FINISHED
-        except (OSError, IOError) as e:
-            self.task.stderr = str(e)
-            status = Proc.ERRORED
+    def adopt(self):
+        """
+        Take over a child left running by an earlier runner on this host
+        :return: False when that child is gone and the task has to run again
+        """
+        task = self.task
+        if not task.pid or task.pid_start is None or task.boot_id != BOOT_ID:
+            return False
+        if process_start(task.pid) != task.pid_start:
+            return False
+
+        self.proc = Orphan(task.pid, task.pid_start)
+        self.adopted = True
+        if self.cgroups:
+            self.cgroup = self.cgroups.attach(task)
+        self.task.commit(status=Proc.PROCESSING, note='task adopted after a runner restart')
+        return True
+
+    def log_tail(self):
+        # An adopted child's pipes died with the old runner -- what it wrote to its log is all there is to keep
+        tail = OutputTail(self.stderr_tail.size)
+        try:
+            with open(self.task.log, 'rb') as f:
+                f.seek(max(os.fstat(f.fileno()).st_size - tail.size, 0))
+                tail.write(f.read())
+        except (OSError, IOError, TypeError):
+            pass
+        return tail
+
+    def reap(self, block=True):
+        """
+        Popen.wait / Popen.poll through wait4, so the child's resource usage is kept -- every wait on the child has to
+        come through here, or Popen reaps it first and the usage is lost
+        :return: the exit code, None while the child is still running
+        """
+        if not isinstance(self.proc, Popen):
+            # Orphans and zygote children are not ours to wait4 -- their handles know how they ended
+            returncode = self.proc.wait() if block else self.proc.poll()
+            self.usage = getattr(self.proc, 'usage', None)
+            return returncode
+
+        if self.proc.returncode is not None:
+            return self.proc.returncode
+        if not self.reap_lock.acquire(block):
+            return None
+        try:
+            if self.proc.returncode is None:
+                pid, status, rusage = os.wait4(self.proc.pid, 0 if block else os.WNOHANG)
+                if pid:
+                    self.usage = usage_of(rusage)
+                    self.proc.returncode = os.waitstatus_to_exitcode(status)
+        except ChildProcessError:
+            pass
+        finally:
+            self.reap_lock.release()
+        return self.proc.returncode
+
+    def stdin_bytes(self):
+        stdin = self.task.stdin or b''
+        if not isinstance(stdin, bytes):
+            stdin = str(stdin).encode('utf-8')
+        return stdin
 
-        if self.task.stderr and log_handle != PIPE:
-            log_handle.write(self.task.stderr)
-        log_handle.close()
+    @property
+    def pipes(self):
+        """
+        The child's pipes the runner still has to service, with the selector event each one waits on
+        :return:
+        """
+        pipes = [(pipe, EVENT_READ) for pipe in self.sinks if not pipe.closed]
+        if self.proc.stdin and not self.proc.stdin.closed:
+            pipes.append((self.proc.stdin, EVENT_WRITE))
+        return pipes
+
+    def service(self, pipe, chunk_size=65536):
+        """
+        Move at most one chunk through a ready pipe -- closes the pipe and returns False once it is done
+        :param pipe:
+        :param chunk_size:
+        :return:
+        """
+        if pipe is self.proc.stdin:
+            try:
+                self.stdin_pending = self.stdin_pending[os.write(pipe.fileno(), self.stdin_pending[:PIPE_BUF]):]
+            except BrokenPipeError:
+                self.stdin_pending = self.stdin_pending[:0]
+            if self.stdin_pending:
+                return True
+            pipe.close()
+            return False
+
+        chunk = os.read(pipe.fileno(), chunk_size)
+        if not chunk:
+            pipe.close()
+            return False
+
+        tail, handle = self.sinks[pipe]
+        tail.write(chunk)
+        if handle:
+            handle.write(chunk)
+        return True
+
+    def stream(self):
+        with DefaultSelector() as selector:
+            for pipe, event in self.pipes:
+                selector.register(pipe, event)
+
+            while selector.get_map():
+                for key, _ in selector.select():
+                    if not self.service(key.fileobj):
+                        selector.unregister(key.fileobj)
+
+    def finish(self, status):
+        if self.log_handle:
+            self.log_handle.close()
+
+        if self.adopted:
+            self.stdout_tail = self.log_tail()
+        self.collect_stderr()
+
+        self.task.stdout = self.stdout_tail.text if self.stdout_tail else None
+        self.task.stderr = self.stderr_tail.text
 
         if self.task.stderr and self.exit_code:
             status = Proc.ERRORED
 
-        self.task.stderr = str(self.task.stderr)
+        # Nobody saw how an adopted child or a dead zygote's child ended -- it must not pass for a success
+        if self.proc is not None and self.exit_code == Orphan.LOST:
+            status = Proc.LOST
+
+        if self.timed_out:
+            status = Proc.TIMEDOUT
+
+        if self.cgroup:
+            self.task.cgroup = self.cgroup.stats
+            if self.task.cgroup['oom_kills']:
+                status = Proc.OOMKILLED
+            self.cgroup.remove()
+
         self.task.exit_code = self.exit_code
-        self.task.end_time = timestamp()
+        self.task.usage = self.usage
+        self.task.end_time = now()
         self.task.commit(status=status, note='task complete -- code: {}, status: {}'.format(self.task.exit_code,
                                                                                             status))
 
+    def fail(self, error):
+        self.stderr_tail.write(str(error).encode('utf-8'))
+        self.finish(Proc.ERRORED)
+
     @classmethod
     def statuses(cls):
         return [v for k, v in vars(cls).items() if k.isupper()]
@@ -123,49 +686,597 @@ class Proc(object):
     def finished(self):
         return isinstance(self.exit_code, int)
 
+    @property
+    def running(self):
+        return self.proc is not None and self.reap(block=False) is None
+
     @property
     def cmd(self):
         return self.task.cmd
 
+    def send_signal(self, sig):
+        # Not Popen.send_signal -- it polls, which would reap the child without keeping its usage
+        if self.running:
+            try:
+                os.kill(self.proc.pid, sig)
+            except OSError:
+                pass
+
     def terminate(self):
         if self.proc:
-            self.proc.terminate()
+            self.send_signal(SIGTERM)
             self.suspended = False
 
     def kill(self):
         if self.proc:
-            self.proc.kill()
+            self.send_signal(SIGKILL)
             self.suspended = False
 
+    def signal_group(self, sig):
+        # Children run in their own session so grandchildren holding the output pipes go down with the leader
+        if self.proc:
+            try:
+                os.killpg(self.proc.pid, sig)
+            except OSError:
+                pass
+
+    def expire(self):
+        if self.proc:
+            self.timed_out = True
+            self.signal_group(SIGTERM)
+
     def pause(self):
         if self.proc:
-            self.proc.send_signal(SIGSTOP)
+            self.send_signal(SIGSTOP)
             self.suspended = True
 
     def resume(self):
         if self.proc:
-            self.proc.send_signal(SIGCONT)
+            self.send_signal(SIGCONT)
             self.suspended = False
 
 
+class BatchHelpers(object):
+    """
+    Helper processes left idle by finished micro batches, kept per cwd/env so the next batch with the same signature
+    does not pay for a python start -- at most `size` are kept, the oldest go first
+    """
+
+    __slots__ = (
+        'size',
+        'tail_size',
+        'timeout_grace',
+        'idle',
+        'lock',
+    )
+
+    def __init__(self, size, tail_size=65536, timeout_grace=10):
+        self.size = size
+        self.tail_size = tail_size
+        self.timeout_grace = timeout_grace
+        self.idle = []
+        self.lock = Lock()
+
+    @staticmethod
+    def key(task):
+        return task.cwd, repr(sorted((task.env or {}).items()))
+
+    def take(self, task):
+        key = BatchHelpers.key(task)
+        with self.lock:
+            for i, (k, helper) in enumerate(self.idle):
+                if k == key:
+                    del self.idle[i]
+                    if helper.poll() is None:
+                        return helper
+                    break
+        return Popen([sys.executable, BatchProc.HELPER, str(self.tail_size), str(self.timeout_grace)],
+                     stdin=PIPE, stdout=PIPE, cwd=task.cwd, env=task.env, close_fds=True)
+
+    def give(self, task, helper):
+        with self.lock:
+            self.idle.append((BatchHelpers.key(task), helper))
+            retired = self.idle[:-self.size] if len(self.idle) > self.size else []
+            del self.idle[:len(retired)]
+        for _, helper in retired:
+            BatchHelpers.close(helper)
+
+    @staticmethod
+    def close(helper):
+        try:
+            helper.stdin.close()
+        except (OSError, IOError):
+            pass
+        helper.wait()
+
+
+class BatchProc(object):
+    """
+    A micro batch -- tiny tasks with one cwd/env signature run back to back by a single helper process in the slot of
+    the first one, with one thread, one event per task and one bulk write for the whole batch
+    """
+
+    HELPER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'batch_helper.py')
+
+    __slots__ = (
+        'tasks',
+        'task',
+        'proc',
+        'helpers',
+    )
+
+    def __init__(self, tasks, helpers):
+        self.tasks = tasks
+        self.task = tasks[0]
+        self.proc = None
+        self.helpers = helpers
+
+    def __repr__(self):
+        return 'batch of {}: {}'.format(len(self.tasks), self.task)
+
+    def __str__(self):
+        return self.__repr__()
+
+    @staticmethod
+    def batchable(task):
+        # Tasks that need their own stdin or their stdout tail on the document still run on their own
+        return bool(task.micro_batch and task.log and not task.stdin)
+
+    @staticmethod
+    def signature(task):
+        return (type(task), task.cpus, task.memory_mb) + BatchHelpers.key(task)
+
+    @property
+    def name(self):
+        return self.task.name
+
+    def run(self):
+        try:
+            self.proc = self.helpers.take(self.task)
+        except (OSError, IOError) as e:
+            for task in self.tasks:
+                self.settle(task, {'error': 'the micro batch helper did not start: {}'.format(e)})
+            return self.finish()
+
+        failed = False
+        for task in self.tasks:
+            request = {'cmd': task.cmd, 'log': task.log, 'timeout': task.timeout}
+            try:
+                self.proc.stdin.write(json.dumps(request).encode('utf-8') + b'\n')
+                self.proc.stdin.flush()
+                result = json.loads(self.proc.stdout.readline())
+            except (OSError, IOError, ValueError) as e:
+                failed = True
+                result = {'error': 'the micro batch helper failed: {!r}'.format(e)}
+            self.settle(task, result)
+
+        if failed:
+            BatchHelpers.close(self.proc)
+        else:
+            self.helpers.give(self.task, self.proc)
+        self.finish()
+
+    def settle(self, task, result):
+        # The same outcome Proc.finish would have given the task on its own
+        exit_code = result.get('exit_code', -9999)
+        stderr = result.get('stderr') or result.get('error') or ''
+
+        status = Proc.FINISHED
+        if (stderr and exit_code) or result.get('error'):
+            status = Proc.ERRORED
+        if result.get('timed_out'):
+            status = Proc.TIMEDOUT
+
+        task.pid = result.get('pid')
+        task.boot_id = BOOT_ID
+        task.start_time = from_epoch(result['start']) if result.get('start') else now()
+        task.end_time = from_epoch(result['end']) if result.get('end') else now()
+        task.stdout = None
+        task.stderr = stderr
+        task.exit_code = exit_code
+        task.usage = result.get('usage')
+        task.status = status
+        task.add_note('task complete -- code: {}, status: {} (micro batch)'.format(exit_code, status))
+
+    def finish(self):
+        type(self.task).commit_many(self.tasks)
+
+
+class DeadlineHeap(object):
+    """
+    One thread and one heap for every pending deadline in the pool -- schedule and cancel are O(log n) and amortized
+    O(1)
+    """
+
+    __slots__ = (
+        'heap',
+        'cancelled',
+        '__counter',
+        '__block',
+    )
+
+    def __init__(self):
+        self.heap = []
+        self.cancelled = 0
+        self.__counter = count()
+        self.__block = Condition()
+
+        t = Thread(target=self.__run)
+        t.daemon = True
+        t.start()
+        del t
+
+    def __len__(self):
+        return len(self.heap)
+
+    def schedule(self, delay, callback, *args):
+        entry = [time() + delay, next(self.__counter), callback, args]
+        with self.__block:
+            heappush(self.heap, entry)
+            if self.heap[0] is entry:
+                self.__block.notify()
+        return entry
+
+    def cancel(self, entry):
+        # Lazy delete -- drop the references now, the entry itself falls out of the heap when it comes due, or when
+        # cancelled entries make up more than half of the heap and it is rebuilt without them
+        with self.__block:
+            if entry[2] is None:
+                return
+            entry[2] = None
+            entry[3] = ()
+            self.cancelled += 1
+            if self.cancelled * 2 > len(self.heap):
+                self.heap = [x for x in self.heap if x[2] is not None]
+                heapify(self.heap)
+                self.cancelled = 0
+
+    def __run(self):
+        while True:
+            with self.__block:
+                while not self.heap:
+                    self.__block.wait()
+                delay = self.heap[0][0] - time()
+                if delay > 0:
+                    self.__block.wait(delay)
+                    continue
+                entry = heappop(self.heap)
+                _, _, callback, args = entry
+                if callback is None:
+                    self.cancelled -= 1
+                # Due -- cancelling it from now on is a no-op
+                entry[2] = None
+            if callback:
+                callback(*args)
+
+
+class Reaper(object):
+    """
+    Supervises every running child from one selector thread -- output pipes and pidfds are watched together instead
+    of parking a thread per process in a blocking read
+    """
+
+    __slots__ = (
+        'callback',
+        'poll_interval',
+        'procs',
+        '__orphans',
+        '__selector',
+        '__pending',
+        '__wakeup_read',
+        '__wakeup_write',
+    )
+
+    def __init__(self, callback, poll_interval=0.5):
+        assert callable(callback), 'The Reaper needs a callback to hand finished procs to'
+
+        self.callback = callback
+        self.poll_interval = poll_interval
+        self.procs = {}
+        self.__orphans = set()
+        self.__selector = DefaultSelector()
+        self.__pending = Queue()
+        self.__wakeup_read, self.__wakeup_write = os.pipe()
+        os.set_blocking(self.__wakeup_write, False)
+        self.__selector.register(self.__wakeup_read, EVENT_READ)
+
+        t = Thread(target=self.__run)
+        t.daemon = True
+        t.start()
+        del t
+
+    def __len__(self):
+        return len(self.procs)
+
+    def add(self, proc):
+        self.__pending.put(proc)
+        try:
+            os.write(self.__wakeup_write, b'1')
+        except BlockingIOError:
+            pass
+
+    def __register(self, proc):
+        # Tracked before anything can fail, so a proc that raises here can still be dropped
+        state = self.procs[proc] = [0, None]
+        for pipe, event in proc.pipes:
+            self.__selector.register(pipe, event, proc)
+            state[0] += 1
+
+        # Without pidfds (python < 3.9, linux < 5.3) exits are found by polling once the pipes have closed
+        try:
+            state[1] = os.pidfd_open(proc.pid)
+            self.__selector.register(state[1], EVENT_READ, proc)
+        except (AttributeError, OSError):
+            if state[1] is not None:
+                os.close(state[1])
+                state[1] = None
+
+        self.__settle(proc)
+
+    def __settle(self, proc):
+        open_pipes, pidfd = self.procs[proc]
+        if open_pipes:
+            return
+        if proc.reap(block=False) is None:
+            if pidfd is None:
+                self.__orphans.add(proc)
+            return
+
+        if pidfd is not None:
+            self.__selector.unregister(pidfd)
+            os.close(pidfd)
+        del self.procs[proc]
+        self.__orphans.discard(proc)
+
+        # A failed write loses this task's record, not the supervisor -- its slot is released either way
+        try:
+            proc.finish(Proc.FINISHED)
+        except Exception as e:
+            LOGGER.error('Recording the end of {} failed: {!r}'.format(proc.name, e))
+        self.callback(proc)
+
+    def __drop(self, proc, error):
+        """
+        Stop supervising a proc that raised -- a thread of its own drains, reaps and completes it instead, like the
+        threads supervisor would have
+        """
+        LOGGER.error('Supervising {} failed: {!r}'.format(proc.name, error))
+        if proc not in self.procs:
+            return
+        for key in list(self.__selector.get_map().values()):
+            if key.data is proc:
+                self.__selector.unregister(key.fileobj)
+        _, pidfd = self.procs.pop(proc)
+        self.__orphans.discard(proc)
+        if pidfd is not None:
+            os.close(pidfd)
+
+        def __complete(this, proc):
+            try:
+                proc.stream()
+                proc.reap()
+                proc.finish(Proc.FINISHED)
+            except Exception as e:
+                LOGGER.error('Completing {} failed: {!r}'.format(proc.name, e))
+            finally:
+                this.callback(proc)
+
+        t = Thread(target=__complete, args=(self, proc))
+        t.daemon = True
+        t.start()
+        del t
+
+    def __run(self):
+        while True:
+            for key, _ in self.__selector.select(self.poll_interval if self.__orphans else None):
+                proc = key.data
+
+                if proc is None:
+                    os.read(self.__wakeup_read, 4096)
+                    while not self.__pending.empty():
+                        proc = self.__pending.get()
+                        try:
+                            self.__register(proc)
+                        except Exception as e:
+                            self.__drop(proc, e)
+                    continue
+
+                if proc not in self.procs:
+                    continue
+
+                try:
+                    self.__service(proc, key.fileobj)
+                except Exception as e:
+                    self.__drop(proc, e)
+
+            for proc in list(self.__orphans):
+                try:
+                    self.__settle(proc)
+                except Exception as e:
+                    self.__drop(proc, e)
+
+    def __service(self, proc, fileobj):
+        state = self.procs[proc]
+        if fileobj == state[1]:
+            # The child exited -- stop watching the pidfd, the pipes may still be draining
+            self.__selector.unregister(state[1])
+            os.close(state[1])
+            state[1] = None
+        else:
+            try:
+                still_open = proc.service(fileobj)
+            except (OSError, IOError):
+                fileobj.close()
+                still_open = False
+            if still_open:
+                return
+            self.__selector.unregister(fileobj)
+            state[0] -= 1
+
+        self.__settle(proc)
+
+
+class Capacity(object):
+    """
+    The CPUs and memory the pool hands out -- tasks declare `cpus` and `memory_mb` and start while they fit, with
+    smaller tasks backfilled around a larger one that has to wait
+    """
+
+    __slots__ = (
+        'cpus',
+        'memory_mb',
+        'held',
+        '__block',
+    )
+
+    def __init__(self, cpus, memory_mb=None):
+        assert cpus > 0, 'The pool needs at least some cpus to hand out'
+
+        self.cpus = cpus
+        self.memory_mb = memory_mb
+        self.held = {}
+        self.__block = Condition()
+
+    def __len__(self):
+        return len(self.held)
+
+    def demand(self, task):
+        # More than the whole pool is clamped to the whole pool, so an oversized task runs alone instead of never
+        cpus = min(task.cpus or 1, self.cpus)
+        memory_mb = task.memory_mb or 0
+        if self.memory_mb is not None:
+            memory_mb = min(memory_mb, self.memory_mb)
+        return cpus, memory_mb
+
+    @property
+    def free(self):
+        cpus = self.cpus - sum(x[0] for x in self.held.values())
+        memory_mb = None
+        if self.memory_mb is not None:
+            memory_mb = self.memory_mb - sum(x[1] for x in self.held.values())
+        return cpus, memory_mb
+
+    @property
+    def room(self):
+        """
+        How many single cpu tasks would still fit -- the size of the next batch worth claiming
+        """
+        return max(int(self.free[0]), 0)
+
+    @staticmethod
+    def fits(need, free):
+        return need[0] <= free[0] + 1e-9 and (free[1] is None or need[1] <= free[1])
+
+    def hold(self, task):
+        """
+        Count the task against the pool unconditionally -- admit decides whether it should
+        """
+        cpus, memory_mb = self.demand(task)
+        with self.__block:
+            self.held[task._id] = (cpus, memory_mb, time() + task.timeout if task.timeout else float('inf'))
+
+    def acquire(self, task):
+        # Blocking, first come first served admission of a single task
+        need = self.demand(task)
+        with self.__block:
+            while not Capacity.fits(need, self.free):
+                self.__block.wait()
+            self.hold(task)
+
+    def release(self, task):
+        with self.__block:
+            self.held.pop(task._id, None)
+            self.__block.notify_all()
+
+    def __reserve(self, need, free):
+        """
+        When the blocked task could start, going by the running tasks' timeouts, and what it leaves over at that point
+        """
+        cpus, memory_mb = free
+        for held_cpus, held_memory_mb, end in sorted(self.held.values(), key=lambda x: x[2]):
+            cpus += held_cpus
+            if memory_mb is not None:
+                memory_mb += held_memory_mb
+            if Capacity.fits(need, (cpus, memory_mb)):
+                return end, (cpus - need[0], None if memory_mb is None else memory_mb - need[1])
+        return float('inf'), (cpus - need[0], None if memory_mb is None else memory_mb - need[1])
+
+    def admit(self, queued):
+        """
+        Hold capacity for every queued task that can start now. Tasks start in priority order until one does not fit;
+        that one gets a reservation and later tasks only backfill if their timeout ends before it could start, or if
+        they fit in what it leaves over (EASY backfill)
+        :param queued: tasks in priority order
+        :return: the tasks to launch
+        """
+        admitted = []
+        with self.__block:
+            free = self.free
+            shadow, spare = None, None
+            for task in queued:
+                need = self.demand(task)
+                if not Capacity.fits(need, free):
+                    if shadow is None:
+                        shadow, spare = self.__reserve(need, free)
+                    continue
+
+                if shadow is not None:
+                    ends = time() + task.timeout if task.timeout else float('inf')
+                    if not ends <= shadow < float('inf'):
+                        if not Capacity.fits(need, spare):
+                            continue
+                        spare = (spare[0] - need[0], None if spare[1] is None else spare[1] - need[1])
+
+                self.hold(task)
+                free = (free[0] - need[0], None if free[1] is None else free[1] - need[1])
+                admitted.append(task)
+        return admitted
+
+
 class ProcPool(object):
 
     __slots__ = (
         'pool',
         'size',
+        'timeout_grace',
+        'tail_size',
         'output_stream',
         'event_stream',
-        '__open_slot_stream',
+        'cgroups',
+        'batch_size',
+        '__zygote',
+        '__helpers',
+        '__capacity',
+        '__wakeup',
+        '__deadlines',
+        '__reaper',
     )
 
-    def __init__(self, size):
+    SUPERVISORS = ('threads', 'selector')
+
+    SPAWNERS = ('popen', 'zygote')
+
+    def __init__(self, size, timeout_grace=10, tail_size=65536, supervisor='threads', memory_mb=None, cgroups=None,
+                 batch_size=0, spawner='popen'):
+        assert supervisor in ProcPool.SUPERVISORS, \
+            'supervisor must be one of: {}'.format(', '.join(ProcPool.SUPERVISORS))
+        assert spawner in ProcPool.SPAWNERS, 'spawner must be one of: {}'.format(', '.join(ProcPool.SPAWNERS))
+
         self.pool = {}
         self.size = size
+        self.timeout_grace = timeout_grace
+        self.tail_size = tail_size
+        self.cgroups = cgroups
+        # A cgroup per task and a helper shared by many tasks do not mix
+        self.batch_size = 0 if cgroups else batch_size or 0
+        self.__helpers = BatchHelpers(size, tail_size, timeout_grace)
+        # Started first, while the runner holds no tasks and no threads yet
+        self.__zygote = Zygote() if spawner == 'zygote' else None
         self.event_stream = Queue()
-        self.__open_slot_stream = Queue()
-
-        for i in range(size):
-            self.__open_slot_stream.put(True)
+        self.__capacity = Capacity(size, memory_mb)
+        self.__wakeup = _Event()
+        self.__deadlines = DeadlineHeap()
+        self.__reaper = Reaper(self.__complete_proc) if supervisor == 'selector' else None
 
     def __setitem__(self, key, value):
         self.pool[key] = value
@@ -180,24 +1291,84 @@ class ProcPool(object):
     def running(self):
         return self.pool.values()
 
+    def __begin_proc(self, proc):
+        self[proc.name] = proc
+        self.event_stream.put(Event(artifact=Artifact(status=Proc.PROCESSING,
+                                                      parent_url=proc.task.parent_url,
+                                                      to_delete=None)))
+        if proc.task.timeout:
+            timeout = proc.task.timeout
+            if proc.adopted and isinstance(proc.task.start_time, datetime):
+                timeout = max(timeout - (now() - proc.task.start_time).total_seconds(), 0)
+            proc.deadline = self.__deadlines.schedule(timeout, self.__expire_proc, proc)
+
+    def __complete_proc(self, proc, tasks=None):
+        if getattr(proc, 'deadline', None):
+            self.__deadlines.cancel(proc.deadline)
+        self.__remove_proc(proc)
+        for task in tasks or [proc.task]:
+            self.event_stream.put(Event(artifact=Artifact(status=task.status,
+                                                          parent_url=task.parent_url,
+                                                          to_delete=task)))
+        self.__capacity.release(proc.task)
+        self.__wakeup.set()
+
     def __launch_proc(self, proc):
 
+        if self.__reaper is not None:
+            self.__begin_proc(proc)
+            try:
+                if not proc.adopted:
+                    proc.start()
+            except (OSError, IOError) as e:
+                proc.fail(e)
+                return self.__complete_proc(proc)
+            return self.__reaper.add(proc)
+
         def __add_run(this, proc):
-            this[proc.name] = proc
-            self.event_stream.put(Event(artifact=Artifact(status=Proc.PROCESSING,
-                                                          parent_url=proc.task.parent_url,
-                                                          to_delete=None)))
-            proc.run()
-            self.event_stream.put(Event(artifact=Artifact(status=proc.task.status,
-                                                          parent_url=proc.task.parent_url,
-                                                          to_delete=proc.task)))
-            this.__open_slot_stream.put(True)
+            this.__begin_proc(proc)
+            try:
+                proc.run()
+            except Exception as e:
+                LOGGER.error('Running {} failed: {!r}'.format(proc.name, e))
+            finally:
+                this.__complete_proc(proc)
             del proc
 
         t = Thread(target=__add_run, args=(self, proc))
         t.start()
         del t
 
+    def __launch_batch(self, batch):
+
+        def __run_batch(this, batch):
+            this[batch.name] = batch
+            this.event_stream.put(Event(artifact=Artifact(status=Proc.PROCESSING,
+                                                          parent_url=batch.task.parent_url,
+                                                          to_delete=None)))
+            try:
+                batch.run()
+            except Exception as e:
+                LOGGER.error('Running {} failed: {!r}'.format(batch.name, e))
+            finally:
+                this.__complete_proc(batch, tasks=batch.tasks)
+            del batch
+
+        t = Thread(target=__run_batch, args=(self, batch))
+        t.start()
+        del t
+
+    def __expire_proc(self, proc):
+        if not proc.running:
+            return
+        proc.expire()
+        proc.deadline = self.__deadlines.schedule(self.timeout_grace, self.__kill_proc, proc)
+
+    def __kill_proc(self, proc):
+        # Not once the proc completed -- the group may be gone and its id reused by then
+        if self.pool.get(proc.name) is proc:
+            proc.signal_group(SIGKILL)
+
     def __remove_proc(self, proc):
         try:
             del self.pool[proc.name]
@@ -208,10 +1379,9 @@ class ProcPool(object):
 
         def __poll_input(this, priority_pool):
             while True:
-                _ = this.__open_slot_stream.get()
-                this.__open_slot_stream.task_done()
                 new_task = priority_pool.pop()
-                new_proc = Proc(new_task)
+                this.__capacity.acquire(new_task)
+                new_proc = Proc(new_task, tail_size=this.tail_size, cgroups=this.cgroups, zygote=this.__zygote)
                 this.__launch_proc(new_proc)
 
         priority_pool = PriorityPool(pool=tasks)
@@ -222,35 +1392,103 @@ class ProcPool(object):
 
         return priority_pool
 
-    def start(self, startup_callback, next_task_callback):
-
-        assert callable(startup_callback) and callable(next_task_callback), 'to start the proc pool,' \
-                                                                            'pass a startup function ' \
-                                                                            'and a get next function'
-
-        def __get_next(this, startup_callback, input_callback):
-
+    @property
+    def capacity(self):
+        return self.__capacity
+
+    def wake(self):
+        self.__wakeup.set()
+
+    def __admit(self, priority_pool):
+        admitted = self.__capacity.admit(priority_pool.ordered)
+        priority_pool.take(admitted)
+        batches = self.__pack(admitted, priority_pool) if self.batch_size > 1 else []
+        for task in admitted:
+            self.__launch_proc(Proc(task, tail_size=self.tail_size, cgroups=self.cgroups, zygote=self.__zygote))
+        for batch in batches:
+            self.__launch_batch(BatchProc(batch, self.__helpers))
+        return len(admitted) + len(batches)
+
+    def __pack(self, admitted, priority_pool):
+        """
+        Move the batchable tasks out of admitted into micro batches -- admitted tasks that share a signature join the
+        first one's batch and give their slot back, then each batch is topped up with the run of matching tasks at the
+        head of the queue
+        :return: lists of tasks, each to run in the slot of its first task
+        """
+        packed = []
+        plain = []
+        open_batches = {}
+        for task in admitted:
+            if not BatchProc.batchable(task):
+                plain.append(task)
+                continue
+            signature = BatchProc.signature(task)
+            batch = open_batches.get(signature)
+            if batch is not None and len(batch) < self.batch_size:
+                self.__capacity.release(task)
+                batch.append(task)
+                continue
+            batch = open_batches[signature] = [task]
+            packed.append(batch)
+        # Split by identity -- tasks compare equal on priority alone, so list.remove could drop the wrong one
+        admitted[:] = plain
+
+        for batch in packed:
+            if len(batch) >= self.batch_size:
+                continue
+            signature = BatchProc.signature(batch[0])
+            extra = []
+            for task in priority_pool.ordered:
+                if len(batch) + len(extra) >= self.batch_size or not BatchProc.batchable(task) or \
+                        BatchProc.signature(task) != signature:
+                    break
+                extra.append(task)
+            priority_pool.take(extra)
+            batch.extend(extra)
+        return packed
+
+    def start(self, startup_callback, next_batch_callback, poll_interval=10, priority_pool=None):
+
+        assert callable(startup_callback) and callable(next_batch_callback), 'to start the proc pool,' \
+                                                                             'pass a startup function ' \
+                                                                             'and a get next batch function'
+
+        def __get_next(this, startup_callback, input_callback, priority_pool):
+
+            # Children still running from before a restart are adopted as they are, the rest run again
             for task in startup_callback():
-                _ = this.__open_slot_stream.get()
-                new_proc = Proc(task)
-                this.__launch_proc(new_proc)
+                proc = Proc(task, tail_size=this.tail_size, cgroups=this.cgroups, zygote=this.__zygote)
+                if proc.adopt():
+                    this.__capacity.hold(task)
+                    this.__launch_proc(proc)
+                else:
+                    priority_pool.put(task)
 
             while True:
-                _ = this.__open_slot_stream.get()
-                new_task = None
-                while not new_task:
-                    new_task = input_callback()
-                    if new_task:
-                        break
-                    sleep(10)
-                new_proc = Proc(new_task)
-                this.__launch_proc(new_proc)
-
-        t = Thread(target=__get_next, args=(self, startup_callback, next_task_callback))
+                this.__wakeup.clear()
+                this.__admit(priority_pool)
+
+                # Keep about as many claimed tasks waiting as could still fit, so there is something to backfill with
+                wanted = this.__capacity.room * max(this.batch_size, 1) - len(priority_pool)
+                if wanted > 0:
+                    for new_task in input_callback(wanted):
+                        priority_pool.put(new_task)
+                    if this.__admit(priority_pool):
+                        continue
+
+                # Finished procs and new task notifications both set the wake up
+                this.__wakeup.wait(poll_interval)
+
+        if priority_pool is None:
+            priority_pool = PriorityPool()
+        t = Thread(target=__get_next, args=(self, startup_callback, next_batch_callback, priority_pool))
         t.daemon = True
         t.start()
         del t
 
+        return priority_pool
+
 
 class PriorityPool(object):
 
@@ -287,8 +1525,29 @@ class PriorityPool(object):
             while self.empty:
                 self.__block.wait()
         item = heappop(self.pool)
+        self.map.pop(getattr(item, '_id'), None)
         return item
 
+    def take(self, items):
+        """
+        Remove any items from the pool, not just the top one -- for backfilling around an item that has to wait
+        """
+        if not items:
+            return
+        with self.__block:
+            taken = set(id(item) for item in items)
+            self.pool = [item for item in self.pool if id(item) not in taken]
+            heapify(self.pool)
+        for item in items:
+            self.map.pop(getattr(item, '_id'), None)
+
+    def __len__(self):
+        return len(self.pool)
+
+    @property
+    def ordered(self):
+        return sorted(self.pool)
+
     @property
     def empty(self):
         return bool(not self.pool)
@@ -296,3 +1555,152 @@ class PriorityPool(object):
     @property
     def all(self):
         return self.pool
+
+
+class FairPool(object):
+    """
+    Stride scheduling across users -- each user's tasks queue in priority order and every task dispatched advances its
+    user's pass by 1 / weight; the next task is the top of the queue of the user with the lowest pass. Tasks taken out
+    of turn (backfill) stay in their queue until they surface, so put, pop and take are all O(log n)
+    """
+
+    __slots__ = (
+        'weights',
+        'default_weight',
+        'queues',
+        'passes',
+        'counts',
+        'turns',
+        'map',
+        '__clock',
+        '__order',
+        '__block',
+    )
+
+    def __init__(self, weights=None, default_weight=1, pool=None):
+        assert default_weight > 0, 'The default fair share weight must be positive'
+
+        self.weights = weights or {}
+        self.default_weight = default_weight
+        self.queues = {}
+        self.passes = {}
+        self.counts = {}
+        self.turns = []
+        self.map = {}
+        self.__clock = 0.0
+        self.__order = count()
+        self.__block = Condition()
+
+        for item in pool or []:
+            self.put(item)
+
+    def stride(self, user):
+        return 1.0 / (self.weights.get(user) or self.default_weight)
+
+    def __live(self, item):
+        return self.map.get(getattr(item, '_id')) is item
+
+    def __now(self):
+        # The lowest live pass -- users that become active start here instead of cashing in their idle time
+        while self.turns and self.turns[0][0] != self.passes.get(self.turns[0][2]):
+            heappop(self.turns)
+        if self.turns:
+            self.__clock = self.turns[0][0]
+        return self.__clock
+
+    def __charge(self, user):
+        self.passes[user] += self.stride(user)
+        if self.counts[user]:
+            heappush(self.turns, (self.passes[user], next(self.__order), user))
+
+    def __remove(self, item):
+        user = item.user
+        del self.map[getattr(item, '_id')]
+        self.counts[user] -= 1
+        self.__charge(user)
+
+        queue = self.queues[user]
+        while queue and not self.__live(queue[0]):
+            heappop(queue)
+        if not self.counts[user]:
+            del self.queues[user]
+
+    def put(self, item, index=None):
+        assert getattr(item, '_id'), 'Item must a id assigned to it for indexing'
+        user = item.user
+        with self.__block:
+            self.map[getattr(item, '_id')] = item
+            heappush(self.queues.setdefault(user, []), item)
+            self.counts[user] = self.counts.get(user, 0) + 1
+            if self.counts[user] == 1:
+                self.passes[user] = max(self.passes.get(user, 0.0), self.__now())
+                heappush(self.turns, (self.passes[user], next(self.__order), user))
+            self.__block.notify()
+
+    def get(self, index):
+        return self.map.get(index)
+
+    def pop(self):
+        with self.__block:
+            while self.empty:
+                self.__block.wait()
+            self.__now()
+            user = self.turns[0][2]
+            queue = self.queues[user]
+            item = queue[0]
+            self.__remove(item)
+            return item
+
+    def take(self, items):
+        with self.__block:
+            for item in items:
+                if self.__live(item):
+                    self.__remove(item)
+
+    def plan(self, users, size):
+        """
+        How a batch of `size` dispatches would split between these users -- for claiming each user's share
+        :return: {user: number of tasks}
+        """
+        with self.__block:
+            now = self.__now()
+            turns = [(max(self.passes.get(user, 0.0), now), i, user) for i, user in enumerate(set(users))]
+        heapify(turns)
+
+        shares = {}
+        for _ in range(size if turns else 0):
+            user_pass, i, user = heappop(turns)
+            shares[user] = shares.get(user, 0) + 1
+            heappush(turns, (user_pass + self.stride(user), i, user))
+        return shares
+
+    def __len__(self):
+        return len(self.map)
+
+    @property
+    def ordered(self):
+        """
+        The live items in the order pop would hand them out
+        """
+        with self.__block:
+            queues = {user: iter(sorted(x for x in queue if self.__live(x))) for user, queue in self.queues.items()
+                      if self.counts.get(user)}
+            turns = [(self.passes[user], i, user) for i, user in enumerate(queues)]
+        heapify(turns)
+
+        ordered = []
+        while turns:
+            user_pass, i, user = heappop(turns)
+            item = next(queues[user], None)
+            if item is not None:
+                ordered.append(item)
+                heappush(turns, (user_pass + self.stride(user), i, user))
+        return ordered
+
+    @property
+    def empty(self):
+        return not self.map
+
+    @property
+    def all(self):
+        return list(self.map.values())
@@ -1 +1 @@
-from .documents import Document, UserFault, ApplicationFault, Client, InvalidId
+from .documents import Document, UserFault, ApplicationFault, Client, InvalidId, validate_object_id
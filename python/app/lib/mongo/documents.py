@@ -1,6 +1,7 @@
 import sys
-import inspect
 import pymongo
+from pymongo import ReturnDocument, UpdateOne, ReplaceOne
+from pymongo.errors import BulkWriteError, ConnectionFailure
 from bson.objectid import ObjectId
 from bson.errors import InvalidId, InvalidDocument
 
@@ -24,6 +25,46 @@ def validate_object_id(object_id):
     return oid
 
 
+_FIELDS = {}
+
+
+def _fields(cls):
+    """
+    Every slot name a document class can store, cached per class
+    :param cls:
+    :return:
+    """
+    if cls not in _FIELDS:
+        fields = set()
+        for klass in cls.__mro__:
+            for slot in getattr(klass, '__slots__', ()):
+                fields.add('_{}{}'.format(klass.__name__, slot) if slot.startswith('__') else slot)
+        _FIELDS[cls] = fields
+    return _FIELDS[cls]
+
+
+def _sort(sort_by):
+    """
+    A field name sorts descending, a list of (field, direction) pairs is used as is
+    """
+    if isinstance(sort_by, str):
+        return [(sort_by, -1)]
+    return list(sort_by)
+
+
+def _stages(plan):
+    """
+    Every stage of an explain() plan, outermost first
+    """
+    stages = [plan]
+    for key in ('inputStage', 'queryPlan'):
+        if key in plan:
+            stages.extend(_stages(plan[key]))
+    for child in plan.get('inputStages', []):
+        stages.extend(_stages(child))
+    return stages
+
+
 class Fault(Exception):
     pass
 
@@ -98,58 +139,222 @@ class Client(object):
     URL = None
     CLIENT = None
     DB_NAME = None
+    INDEXES = {}
+    # Stamped by claim_many on the documents it claims, and removed again once they are read back
+    CLAIM_TOKEN = '_claim'
     
     @staticmethod
     def get_client():
         return Client.CLIENT
     
     @staticmethod
-    def set(url, db_name):
+    def set(url, db_name, indexes=None):
         Client.URL = url
         Client.DB_NAME = db_name
         Client.CLIENT = getattr(pymongo.MongoClient(Client.URL), Client.DB_NAME)
+        Client.register_indexes(indexes)
 
     @staticmethod
     def override_client(client):
         Client.CLIENT = client
 
+    @staticmethod
+    def register_indexes(indexes):
+        """
+        Register {collection name: [(keys, options), ...]} for ensure_indexes -- nothing is sent to the server, so
+        importing and connecting never block on it
+        """
+        for collection_name, specs in (indexes or {}).items():
+            Client.INDEXES.setdefault(collection_name, []).extend(specs)
+
+    @staticmethod
+    def ensure_indexes(strict=False):
+        """
+        Create every registered index that is missing -- create_index is a no-op for indexes that already exist. The
+        api and the runner call it once at startup
+        :param strict: raise when the server cannot be reached instead of leaving it to the next call
+        :return: True when every registered index is in place
+        """
+        assert Client.CLIENT is not None, \
+            "Before talking to the instance of Mongodb, set the Client with Client.set(url, db_name)"
+
+        try:
+            for collection_name, specs in Client.INDEXES.items():
+                collection = getattr(Client.CLIENT, collection_name)
+                for keys, options in specs:
+                    collection.create_index(keys, **options)
+        except ConnectionFailure as e:
+            if strict:
+                raise ApplicationFault('Unable to create indexes -- {}'.format(e))
+            return False
+        return True
+
+    @staticmethod
+    def explain(collection_name, query, sort_by, limit=1):
+        """
+        The stages and index names of the winning plan for a find
+        :return: ([stage, ...], [index name, ...])
+        """
+        assert Client.CLIENT is not None, \
+            "Before talking to the instance of Mongodb, set the Client with Client.set(url, db_name)"
+
+        explained = getattr(Client.CLIENT, collection_name).find(query).sort(_sort(sort_by)).limit(limit).explain()
+        stages = _stages(explained['queryPlanner']['winningPlan'])
+        return [x.get('stage') for x in stages], [x['indexName'] for x in stages if x.get('indexName')]
+
     @staticmethod
     def next(collection_name, query, sort_by):
-        assert Client.CLIENT, "Before talking to the instance of Mongodb, set the Client with Client.set(url, db_name)"
+        assert Client.CLIENT is not None, \
+            "Before talking to the instance of Mongodb, set the Client with Client.set(url, db_name)"
         assert Document.__name__.lower() != collection_name,\
             "This opperation cannot be performed on the Document base class"
 
         try:
-            return getattr(Client.CLIENT, collection_name).find(query).sort([(sort_by, -1)]).limit(1).next()
+            return getattr(Client.CLIENT, collection_name).find(query).sort(_sort(sort_by)).limit(1).next()
         except StopIteration:
             return {}
 
+    @staticmethod
+    def find_one_and_update(collection_name, query, action, sort_by=None, projection=None, after=True):
+        """
+        Atomically apply any update (operators or a pipeline) to the top matching document
+        :return: the document as it is after the update, or before it with after=False -- None when nothing matched
+        """
+        assert Client.CLIENT is not None, \
+            "Before talking to the instance of Mongodb, set the Client with Client.set(url, db_name)"
+        assert Document.__name__.lower() != collection_name, \
+            "This opperation cannot be performed on the Document base class"
+
+        try:
+            return getattr(Client.CLIENT, collection_name).find_one_and_update(
+                query, action, projection=projection, sort=_sort(sort_by) if sort_by else None,
+                return_document=ReturnDocument.AFTER if after else ReturnDocument.BEFORE)
+        except InvalidDocument as e:
+            raise ApplicationFault('The following issue occurred while trying to update a document {}'.format(e))
+
+    @staticmethod
+    def claim_many(collection_name, query, sort_by, update, limit):
+        assert Client.CLIENT is not None, \
+            "Before talking to the instance of Mongodb, set the Client with Client.set(url, db_name)"
+        assert Document.__name__.lower() != collection_name, \
+            "This opperation cannot be performed on the Document base class"
+        assert update, "claim_many needs a non-empty update to take the documents it claims out of the query"
+
+        collection = getattr(Client.CLIENT, collection_name)
+        candidates = [x['_id'] for x in collection.find(query, {'_id': 1}).sort(_sort(sort_by)).limit(limit)]
+        if not candidates:
+            return []
+
+        # Another claimer may win some of the candidates between the find and the update -- re-reading by a token
+        # only this call wrote returns just the documents it actually moved, whatever else writes to them meanwhile
+        token = ObjectId()
+        claimed = dict(query)
+        claimed['_id'] = {'$in': candidates}
+        try:
+            collection.update_many(claimed, {'$set': dict(update, **{Client.CLAIM_TOKEN: token})})
+        except InvalidDocument as e:
+            raise ApplicationFault('The following issue occurred while trying to claim documents {}'.format(e))
+
+        owned = {'_id': {'$in': candidates}, Client.CLAIM_TOKEN: token}
+        documents = list(collection.find(owned, {Client.CLAIM_TOKEN: 0}).sort(_sort(sort_by)))
+        if documents:
+            collection.update_many(owned, {'$unset': {Client.CLAIM_TOKEN: ''}})
+        return documents
+
+    @staticmethod
+    def cursor(collection_name, query, projection=None, sort=None, limit=0, bound=None):
+        """
+        A lazy cursor over the collection -- `bound` is ANDed onto the sanitized query untouched, for filters such as
+        pagination bounds that already hold ObjectIds
+        """
+        assert Client.CLIENT is not None, \
+            "Before talking to the instance of Mongodb, set the Client with Client.set(url, db_name)"
+        assert Document.__name__.lower() != collection_name, \
+            "This opperation cannot be performed on the Document base class"
+
+        query = Client.__sanitize_query(query)
+        if bound:
+            query = {'$and': [query, bound]}
+
+        cursor = getattr(Client.CLIENT, collection_name).find(query, projection)
+        if sort:
+            cursor = cursor.sort(sort)
+        return cursor.limit(limit)
+
     @staticmethod
     def find(collection_name, query):
         return [x for x in getattr(Client.CLIENT, collection_name).find(Client.__sanitize_query(query))]
 
     @staticmethod
     def find_one(collection_name, query):
-        assert Client.CLIENT, "Before talking to the instance of Mongodb, set the Client with Client.set(url, db_name)"
+        assert Client.CLIENT is not None, \
+            "Before talking to the instance of Mongodb, set the Client with Client.set(url, db_name)"
         assert Document.__name__.lower() != collection_name, \
             "This opperation cannot be performed on the Document base class"
 
         return getattr(Client.CLIENT, collection_name).find_one(Client.__sanitize_query(query))
 
     @staticmethod
-    def update_one(collection_name, filter_data, action):
-        assert Client.CLIENT, "Before talking to the instance of Mongodb, set the Client with Client.set(url, db_name)"
+    def update_one(collection_name, filter_data, action, upsert=False):
+        assert Client.CLIENT is not None, \
+            "Before talking to the instance of Mongodb, set the Client with Client.set(url, db_name)"
         assert Document.__name__.lower() != collection_name, \
             "This opperation cannot be performed on the Document base class"
 
         try:
-            getattr(Client.CLIENT, collection_name).update_one(filter_data, action)
+            getattr(Client.CLIENT, collection_name).update_one(filter_data, action, upsert=upsert)
         except InvalidDocument as e:
             raise ApplicationFault('The following issue occurred while trying to insert this document {}'.format(e))
 
+    @staticmethod
+    def update_many(collection_name, filter_data, action):
+        assert Client.CLIENT is not None, \
+            "Before talking to the instance of Mongodb, set the Client with Client.set(url, db_name)"
+        assert Document.__name__.lower() != collection_name, \
+            "This opperation cannot be performed on the Document base class"
+
+        try:
+            return getattr(Client.CLIENT, collection_name).update_many(filter_data, action).modified_count
+        except InvalidDocument as e:
+            raise ApplicationFault('The following issue occurred while trying to update these documents {}'.format(e))
+
+    @staticmethod
+    def bulk_write(collection_name, operations, ordered=False):
+        assert Client.CLIENT is not None, \
+            "Before talking to the instance of Mongodb, set the Client with Client.set(url, db_name)"
+        assert Document.__name__.lower() != collection_name, \
+            "This opperation cannot be performed on the Document base class"
+
+        if not operations:
+            return 0
+
+        try:
+            return getattr(Client.CLIENT, collection_name).bulk_write(operations, ordered=ordered).modified_count
+        except (BulkWriteError, InvalidDocument) as e:
+            raise ApplicationFault('The following issue occurred while trying to update these documents {}'.format(e))
+
+    @staticmethod
+    def distinct(collection_name, key, query):
+        assert Client.CLIENT is not None, \
+            "Before talking to the instance of Mongodb, set the Client with Client.set(url, db_name)"
+        return getattr(Client.CLIENT, collection_name).distinct(key, Client.__sanitize_query(query))
+
+    @staticmethod
+    def aggregate(collection_name, pipeline):
+        assert Client.CLIENT is not None, \
+            "Before talking to the instance of Mongodb, set the Client with Client.set(url, db_name)"
+        return [x for x in getattr(Client.CLIENT, collection_name).aggregate(pipeline)]
+
+    @staticmethod
+    def count(collection_name, query):
+        assert Client.CLIENT is not None, \
+            "Before talking to the instance of Mongodb, set the Client with Client.set(url, db_name)"
+        return getattr(Client.CLIENT, collection_name).count_documents(Client.__sanitize_query(query))
+
     @staticmethod
     def insert(collection_name, data):
-        assert Client.CLIENT, "Before talking to the instance of Mongodb, set the Client with Client.set(url, db_name)"
+        assert Client.CLIENT is not None, \
+            "Before talking to the instance of Mongodb, set the Client with Client.set(url, db_name)"
         assert Document.__name__.lower() != collection_name, \
             "This opperation cannot be performed on the Document base class"
 
@@ -158,16 +363,66 @@ class Client(object):
         except InvalidDocument as e:
             raise ApplicationFault('The following issue occurred while trying to insert this document {}'.format(e))
 
+    @staticmethod
+    def insert_many(collection_name, data, ordered=False):
+        """
+        Insert every dict in data -- pymongo sets each dict's _id in place
+        :return: [(index, message), ...] for every dict that was not inserted
+        """
+        assert Client.CLIENT is not None, \
+            "Before talking to the instance of Mongodb, set the Client with Client.set(url, db_name)"
+        assert Document.__name__.lower() != collection_name, \
+            "This opperation cannot be performed on the Document base class"
+
+        if not data:
+            return []
+
+        try:
+            getattr(Client.CLIENT, collection_name).insert_many(data, ordered=ordered)
+        except BulkWriteError as e:
+            failed = [(x['index'], x.get('errmsg', 'write failed')) for x in e.details.get('writeErrors', [])]
+            if ordered and failed:
+                # An ordered insert stops at the first error -- nothing after it was written either
+                first = failed[0][0]
+                failed.extend((i, 'not inserted -- an earlier request failed') for i in range(first + 1, len(data)))
+            return failed
+        except InvalidDocument as e:
+            raise ApplicationFault('The following issue occurred while trying to insert these documents {}'.format(e))
+        return []
+
+    @staticmethod
+    def move(source_name, destination_name, query, sort_by, limit):
+        """
+        Move up to limit documents matching query into another collection -- copies are upserts and only documents
+        that still match are deleted, so a move interrupted half way can simply run again
+        :return: number of documents moved
+        """
+        assert Client.CLIENT is not None, \
+            "Before talking to the instance of Mongodb, set the Client with Client.set(url, db_name)"
+
+        source = getattr(Client.CLIENT, source_name)
+        documents = [x for x in source.find(query).sort(_sort(sort_by)).limit(limit)]
+        if not documents:
+            return 0
+
+        Client.bulk_write(destination_name, [ReplaceOne({'_id': x['_id']}, x, upsert=True) for x in documents])
+
+        moved = dict(query)
+        moved['_id'] = {'$in': [x['_id'] for x in documents]}
+        return source.delete_many(moved).deleted_count
+
     @staticmethod
     def remove(collection_name, data):
-        assert Client.CLIENT, "Before talking to the instance of Mongodb, set the Client with Client.set(url, db_name)"
+        assert Client.CLIENT is not None, \
+            "Before talking to the instance of Mongodb, set the Client with Client.set(url, db_name)"
         assert Document.__name__.lower() != collection_name, \
             "This opperation cannot be performed on the Document base class"
         return getattr(Client.CLIENT, collection_name).remove(data)
 
     @staticmethod
     def __sanitize_query(query_data):
-        assert Client.CLIENT, "Before talking to the instance of Mongodb, set the Client with Client.set(url, db_name)"
+        assert Client.CLIENT is not None, \
+            "Before talking to the instance of Mongodb, set the Client with Client.set(url, db_name)"
 
         def __object_convert(oid):
             try:
@@ -216,11 +471,16 @@ class Document(object):
         '__children_type',
         '__parent_key',
         '__parent_type',
+        '__dirty',
+        '__pushed',
     )
 
     def __init__(self, *args, **kwargs):
 
-        self._id = ''
+        self.__dirty = set()
+        self.__pushed = {}
+
+        self.__assign('_id', '')
         self.__type = self.__class__.__name__
 
         self.__children_key = None
@@ -247,18 +507,34 @@ class Document(object):
                 for child in v:
                     att.append(class_(child))
                 continue
+            if k.startswith('_'):
+                self.__assign(k, v)
+                continue
             setattr(self, k, v)
 
+        self.clean()
+
     def __setattr__(self, key, value):
-        previous_frame = inspect.currentframe().f_back.f_code.co_name
+        # Document's own mangled attributes can only be written from inside this class -- every other key
+        # starting with an underscore (_id included) goes through __assign
         try:
-            if previous_frame not in ('__init__', 'insert', 'remove'):
-                assert not key.startswith('_')
+            if key.startswith('_'):
+                assert key.startswith('_Document__')
+                super(Document, self).__setattr__(key, value)
+                return
             super(Document, self).__setattr__(key, value)
+            self.__dirty.add(key)
         except (AttributeError, AssertionError) as e:
             raise UserFault('The {} document only allows for the following keys:'
                             '\n{}'.format(self.__type, '\n'.join(self.__slots__)))
 
+    def __assign(self, key, value):
+        try:
+            object.__setattr__(self, key, value)
+        except AttributeError:
+            raise UserFault('The {} document only allows for the following keys:'
+                            '\n{}'.format(self.__type, '\n'.join(self.__slots__)))
+
     def __getattr__(self, item):
         try:
             return super(Document, self).__getattribute__(item)
@@ -274,9 +550,45 @@ class Document(object):
     def __bool__(self):
         return bool(self.id)
 
+    @classmethod
+    def hydrate(cls, documents):
+        """
+        Build documents from rows read back from the database -- the rows are trusted, so every field is written
+        straight into its slot instead of going through __setattr__
+        :param documents: any iterable of dicts, e.g. a cursor
+        :return:
+        """
+        if cls.SCHEMA.get('children') or cls.SCHEMA.get('parent'):
+            return [cls(x) for x in documents]
+
+        fields = _fields(cls)
+        assign = object.__setattr__
+        hydrated = []
+        for document in documents:
+            obj = cls.__new__(cls)
+            assign(obj, '_Document__dirty', set())
+            assign(obj, '_Document__pushed', {})
+            assign(obj, '_Document__type', cls.__name__)
+            assign(obj, '_Document__children_key', None)
+            assign(obj, '_Document__children_type', None)
+            assign(obj, '_Document__parent_key', None)
+            assign(obj, '_Document__parent_type', None)
+            assign(obj, '_id', '')
+            for k, v in document.items():
+                if k not in fields:
+                    raise UserFault('The {} document only allows for the following keys:'
+                                    '\n{}'.format(cls.__name__, '\n'.join(cls.__slots__)))
+                assign(obj, k, v)
+            hydrated.append(obj)
+        return hydrated
+
     @classmethod
     def query(cls, query):
-        return [cls(x) for x in Client.find(cls.__name__.lower(), query)]
+        return cls.hydrate(Client.find(cls.__name__.lower(), query))
+
+    @classmethod
+    def claim_many(cls, query, sort_by, update, limit):
+        return cls.hydrate(Client.claim_many(cls.__name__.lower(), query, sort_by, update, limit))
 
     @classmethod
     def from_id(cls, object_id):
@@ -292,7 +604,7 @@ class Document(object):
         if not document:
             return cls()
 
-        return cls(document)
+        return cls.hydrate([document])[0]
 
     @property
     def collection(self):
@@ -324,6 +636,48 @@ class Document(object):
             tmp.update({key: attribute})
         return tmp
 
+    def field_value(self, key):
+        """
+        The stored form of a single field -- children are converted to dicts like in Document.dict
+        :param key:
+        :return:
+        """
+        attribute = getattr(self, key)
+        if key == self.__children_key and isinstance(attribute, Children):
+            return [x.dict for x in attribute.list]
+        return attribute
+
+    def push(self, key, item):
+        """
+        Append to a list field -- the next commit sends it as a $push instead of rewriting the list
+        :param key:
+        :param item:
+        :return:
+        """
+        if getattr(self, key) is None:
+            setattr(self, key, [])
+        getattr(self, key).append(item)
+        if key not in self.__dirty:
+            self.__pushed.setdefault(key, []).append(item)
+
+    @property
+    def changes(self):
+        """
+        The update document for everything set or pushed since the last load or commit
+        :return:
+        """
+        action = {}
+        if self.__dirty:
+            action['$set'] = {key: self.field_value(key) for key in self.__dirty}
+        pushed = {key: {'$each': items} for key, items in self.__pushed.items() if key not in self.__dirty}
+        if pushed:
+            action['$push'] = pushed
+        return action
+
+    def clean(self):
+        self.__dirty.clear()
+        self.__pushed.clear()
+
     @property
     def full(self):
         """
@@ -349,13 +703,103 @@ class Document(object):
             raise UserFault('You are trying to insert a document that has already been inserted')
 
         try:
-            self.status = status or 'created'
+            self.status = status or self.status or 'created'
         except UserFault:
             pass
 
-        self._id = Client.insert(self.collection, self.dict)
+        self.__assign('_id', Client.insert(self.collection, self.dict))
+        self.clean()
         return True
 
+    @classmethod
+    def writable(cls, fields):
+        """
+        Split an update dict into the fields this document can store and the keys it has to ignore
+        :param fields:
+        :return: (update, ignored keys)
+        """
+        allowed = _fields(cls)
+        update = {k: v for k, v in fields.items() if k in allowed and not k.startswith('_')}
+        return update, sorted(k for k in fields if k not in update)
+
+    @classmethod
+    def bulk_update(cls, updates, extra=None):
+        """
+        Apply {object id: {field: value}} with one bulk_write instead of a load and a commit per document
+        :param updates:
+        :param extra: fields added to every non-empty update
+        :return: (object ids that had something to write, {object id: ignored keys})
+        """
+        operations = []
+        written = []
+        ignored = {}
+        for object_id, fields in updates.items():
+            oid = validate_object_id(str(object_id))
+            if not isinstance(fields, dict):
+                raise UserFault('The update for "{}" must be a dict of fields'.format(object_id))
+            update, skipped = cls.writable(fields)
+            if skipped:
+                ignored[str(object_id)] = skipped
+            if not update:
+                continue
+            update.update(extra or {})
+            operations.append(UpdateOne({'_id': oid}, {'$set': update}))
+            written.append(oid)
+
+        Client.bulk_write(cls.__name__.lower(), operations)
+        return written, ignored
+
+    @classmethod
+    def update_where(cls, where, fields, extra=None):
+        """
+        Set fields on every document matching where with a single update_many -- list values in where match any of
+        their items
+        :param where:
+        :param fields:
+        :param extra: fields added to the update when it is not empty
+        :return: (modified count, ignored keys)
+        """
+        if not isinstance(where, dict) or not where:
+            raise UserFault('where must be a non-empty dict of fields to match')
+        if not isinstance(fields, dict):
+            raise UserFault('set must be a dict of fields')
+
+        query, skipped = cls.writable(where)
+        if skipped:
+            raise UserFault('Cannot filter on: {}'.format(', '.join(skipped)))
+        query = {k: {'$in': v} if isinstance(v, list) else v for k, v in query.items()}
+
+        update, ignored = cls.writable(fields)
+        if not update:
+            return 0, ignored
+        update.update(extra or {})
+
+        return Client.update_many(cls.__name__.lower(), query, {'$set': update}), ignored
+
+    @classmethod
+    def insert_many(cls, documents, status=None, ordered=False):
+        """
+        Insert documents that have not been inserted yet in one round trip
+        :return: [(index, message), ...] for every document that was not inserted
+        """
+        rows = []
+        for document in documents:
+            if document._id:
+                raise UserFault('You are trying to insert a document that has already been inserted')
+            try:
+                document.status = status or document.status or 'created'
+            except UserFault:
+                pass
+            rows.append(document.dict)
+
+        failed = dict(Client.insert_many(cls.__name__.lower(), rows, ordered=ordered))
+        for index, (document, row) in enumerate(zip(documents, rows)):
+            if index not in failed:
+                document.__assign('_id', row['_id'])
+                document.clean()
+
+        return sorted(failed.items())
+
     def commit(self, status=None):
 
         if not self._id:
@@ -367,9 +811,25 @@ class Document(object):
             except (UserFault, AttributeError):
                 pass
 
-        Client.update_one(self.collection, {'_id': self._id}, {'$set': self.dict})
+        changes = self.changes
+        if changes:
+            Client.update_one(self.collection, {'_id': self._id}, changes)
+            self.clean()
         return True
 
+    @classmethod
+    def commit_many(cls, documents):
+        """
+        Write what changed on several inserted documents with one bulk_write instead of a commit each
+        :param documents:
+        :return: number of documents modified
+        """
+        operations = [UpdateOne({'_id': x._id}, x.changes) for x in documents if x.changes]
+        modified = Client.bulk_write(cls.__name__.lower(), operations)
+        for document in documents:
+            document.clean()
+        return modified
+
     def remove(self):
 
         if not self._id:
@@ -377,6 +837,6 @@ class Document(object):
 
         ret = Client.remove(self.collection, {'_id': self._id})
         if bool(ret.get('n')):
-            self._id = ''
+            self.__assign('_id', '')
 
         return bool(ret.get('n'))
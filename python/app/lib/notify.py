@@ -0,0 +1,77 @@
+import os
+import re
+import socket
+from threading import Thread
+
+
+class Notifier(object):
+    """
+    Wake ups over unix datagram sockets -- every runner listens on its own socket next to the configured path and a
+    notify reaches all of them
+    """
+
+    __slots__ = (
+        'path',
+        'name',
+    )
+
+    def __init__(self, path, name=None):
+        self.path = path
+        self.name = name
+
+    @property
+    def address(self):
+        # Where this process listens -- the configured path itself when it has no name
+        if not self.name:
+            return self.path
+        return '{}.{}'.format(self.path, re.sub(r'[^\w.-]', '_', str(self.name)))
+
+    @property
+    def addresses(self):
+        directory, base = os.path.split(self.path)
+        try:
+            names = os.listdir(directory or '.')
+        except (OSError, IOError):
+            return []
+        return [os.path.join(directory, x) for x in names if x == base or x.startswith(base + '.')]
+
+    def notify(self):
+        sent = False
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        try:
+            for address in self.addresses:
+                try:
+                    sock.sendto(b'1', address)
+                    sent = True
+                except (OSError, IOError):
+                    # Nobody listening or the listener already has wake ups pending -- the poll fallback covers both
+                    continue
+        finally:
+            sock.close()
+        return sent
+
+    def listen(self, callback):
+        assert callable(callback), 'Notifier.listen requires a callable to run on every wake up'
+
+        address = self.address
+        if os.path.exists(address):
+            os.unlink(address)
+        elif not os.path.exists(os.path.dirname(address)):
+            os.makedirs(os.path.dirname(address))
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(address)
+        os.chmod(address, 0o777)
+
+        def __receive(sock, callback):
+            while True:
+                sock.recv(64)
+                callback()
+
+        t = Thread(target=__receive, args=(sock, callback))
+        t.daemon = True
+        t.start()
+        del t
+
+        return sock
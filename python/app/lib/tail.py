@@ -0,0 +1,169 @@
+import os
+import ctypes
+import ctypes.util
+from time import time, sleep
+from select import select
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVE_SELF = 0x00000800
+IN_DELETE_SELF = 0x00000400
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+
+def _libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+_LIBC = _libc()
+
+
+class LogWatch(object):
+    """
+    Wakes a follower when its log is written to -- inotify where the kernel and libc have it, a short sleep otherwise
+    """
+
+    EVENTS = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVE_SELF | IN_DELETE_SELF
+
+    __slots__ = (
+        'fd',
+        'poll_interval',
+    )
+
+    def __init__(self, path, poll_interval=0.5):
+        self.fd = None
+        self.poll_interval = poll_interval
+        if _LIBC is None:
+            return
+
+        fd = _LIBC.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return
+        if _LIBC.inotify_add_watch(fd, os.fsencode(path), LogWatch.EVENTS) < 0:
+            os.close(fd)
+            return
+        self.fd = fd
+
+    def wait(self, timeout):
+        """
+        Block until the log changes or the timeout passes
+        :return: True when it changed (or may have, without inotify)
+        """
+        if self.fd is None:
+            sleep(min(timeout, self.poll_interval))
+            return True
+        if not select([self.fd], [], [], timeout)[0]:
+            return False
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def parse_range(header, size):
+    """
+    A single `bytes=first-last`, `bytes=first-` or `bytes=-suffix` range against a file of `size` bytes
+    :return: (first, last) inclusive, or None when the range cannot be satisfied
+    """
+    unit, _, spec = header.partition('=')
+    first, dash, last = spec.strip().partition('-')
+    if unit.strip() != 'bytes' or not dash or ',' in spec:
+        raise ValueError('Only a single byte range is supported')
+
+    if not first:
+        suffix = int(last)
+        if suffix <= 0 or not size:
+            return None
+        return max(size - suffix, 0), size - 1
+
+    first = int(first)
+    last = min(int(last), size - 1) if last else size - 1
+    if first < 0 or first > last:
+        return None
+    return first, last
+
+
+def tail_offset(f, lines, block_size=65536):
+    """
+    Where the last `lines` lines of an open binary file start, read backwards a block at a time -- a final newline does
+    not start another line
+    """
+    end = f.seek(0, os.SEEK_END)
+    if not lines or not end:
+        return end
+
+    position = end
+    f.seek(end - 1)
+    wanted = lines + 1 if f.read(1) == b'\n' else lines
+    while position > 0:
+        step = min(block_size, position)
+        position -= step
+        f.seek(position)
+        block = f.read(step)
+        index = len(block)
+        while index > 0:
+            index = block.rfind(b'\n', 0, index)
+            if index < 0:
+                break
+            wanted -= 1
+            if not wanted:
+                return position + index + 1
+    return 0
+
+
+def read_range(f, first, length, chunk_size=65536):
+    # Bounded reads for a 206 -- the log may still be growing past `first + length`
+    f.seek(first)
+    while length > 0:
+        chunk = f.read(min(chunk_size, length))
+        if not chunk:
+            return
+        length -= len(chunk)
+        yield chunk
+
+
+def follow_log(path, offset, finished, chunk_size=65536, check_interval=2):
+    """
+    Stream a log from offset, then every byte appended to it until `finished()` says the task is done and the rest has
+    been read
+    :param path:
+    :param offset:
+    :param finished: callable, checked whenever the log has been quiet for check_interval seconds
+    """
+    watch = LogWatch(path)
+    try:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            quiet = time()
+            while True:
+                chunk = f.read(chunk_size)
+                if chunk:
+                    quiet = time()
+                    yield chunk
+                    continue
+                # Without inotify every wait says the log may have changed, so go by how long nothing was read
+                if watch.wait(check_interval) and time() - quiet < check_interval:
+                    continue
+                if finished():
+                    # Whatever was written between the last read and the check
+                    for chunk in iter(lambda: f.read(chunk_size), b''):
+                        yield chunk
+                    return
+                quiet = time()
+    finally:
+        watch.close()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# The runner's spawn server: started while the runner is still small, it posix_spawns every task on the runner's
+# behalf, so spawn latency does not grow with the runner's heap, threads and open fds. It stays the parent of the
+# children and reports each exit, with its wait4 usage, back over a second socket
+# usage: zygote.py <request socket fd> <exit socket fd>
+
+import os
+import sys
+import json
+import errno
+import socket
+import signal
+from shutil import which
+from selectors import DefaultSelector, EVENT_READ
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from manager import usage_of
+
+# stdin, stdout, stderr and optionally a cgroup.procs fd to join before exec
+MAX_FDS = 4
+
+HOME = os.getcwd()
+
+# Python ignores these and an ignored signal survives the exec -- Popen restores them too
+RESTORED_SIGNALS = (signal.SIGPIPE, signal.SIGXFSZ, signal.SIGINT)
+
+
+def failure(e):
+    """
+    The reply for a command that did not start -- str(e) already carries the `[Errno n]` prefix, so the message and
+    filename go apart and the runner raises the same OSError Popen would have
+    :return: {'errno': errno, 'error': message, 'filename': filename}
+    """
+    code = getattr(e, 'errno', None)
+    if code is None:
+        return {'errno': None, 'error': str(e), 'filename': None}
+    filename = getattr(e, 'filename', None)
+    if filename is not None:
+        filename = str(filename)
+    return {'errno': code, 'error': e.strerror or os.strerror(code), 'filename': filename}
+
+
+def spawn(request, fds):
+    """
+    posix_spawn one command -- the zygote is single threaded, so it can step into the command's cwd for the spawn
+    :return: {'pid': pid} or failure(e)
+    """
+    if len(fds) > 3:
+        return fork_exec(request, fds)
+
+    cmd, cwd, env = request['cmd'], request.get('cwd'), request.get('env')
+    env = os.environ if env is None else env
+    try:
+        if cwd:
+            os.chdir(cwd)
+        # Looked up on the command's own PATH like Popen does, not on the zygote's
+        path = which(cmd[0], path=env.get('PATH', os.defpath))
+        if path is None:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), cmd[0])
+        pid = os.posix_spawn(path, cmd, env, setsid=True, setsigdef=RESTORED_SIGNALS,
+                             file_actions=[(os.POSIX_SPAWN_DUP2, fd, target) for target, fd in enumerate(fds)])
+    except OSError as e:
+        return failure(e)
+    finally:
+        if cwd:
+            os.chdir(HOME)
+    return {'pid': pid}
+
+
+def fork_exec(request, fds):
+    """
+    fork and exec one command that first has to join a cgroup through fds[3] -- failures before the exec come back
+    through a close-on-exec pipe, like with Popen
+    """
+    errors_read, errors_write = os.pipe()
+    try:
+        pid = os.fork()
+    except OSError as e:
+        os.close(errors_read)
+        os.close(errors_write)
+        return failure(e)
+
+    if pid == 0:
+        try:
+            os.close(errors_read)
+            for sig in RESTORED_SIGNALS:
+                signal.signal(sig, signal.SIG_DFL)
+            os.write(fds[3], b'0')
+            for target, fd in enumerate(fds[:3]):
+                os.dup2(fd, target)
+            if request.get('cwd'):
+                os.chdir(request['cwd'])
+            os.setsid()
+            cmd = request['cmd']
+            try:
+                if request.get('env') is None:
+                    os.execvp(cmd[0], cmd)
+                os.execvpe(cmd[0], cmd, request['env'])
+            except OSError as e:
+                # Named after the command, like Popen does
+                e.filename = e.filename or cmd[0]
+                raise
+        except BaseException as e:
+            os.write(errors_write, json.dumps(failure(e)).encode('utf-8'))
+        finally:
+            os._exit(127)
+
+    os.close(errors_write)
+    chunks = []
+    while True:
+        chunk = os.read(errors_read, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(errors_read)
+    if not chunks:
+        return {'pid': pid}
+
+    # The child never got to exec -- reap it here, the runner only hears about the error
+    os.waitpid(pid, 0)
+    return json.loads(b''.join(chunks).decode('utf-8'))
+
+
+def reap(exits):
+    while True:
+        try:
+            pid, status, rusage = os.wait4(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if not pid:
+            return
+        exits.send(json.dumps({'exit': pid, 'code': os.waitstatus_to_exitcode(status),
+                              'usage': usage_of(rusage)}).encode('utf-8'))
+
+
+def main(requests_fd, exits_fd):
+    requests = socket.socket(fileno=requests_fd)
+    exits = socket.socket(fileno=exits_fd)
+    # pass_fds left them inheritable -- the tasks must not hold the runner's sockets open
+    requests.set_inheritable(False)
+    exits.set_inheritable(False)
+    wakeup_read, wakeup_write = os.pipe()
+    os.set_blocking(wakeup_write, False)
+    signal.set_wakeup_fd(wakeup_write)
+    signal.signal(signal.SIGCHLD, lambda *_: None)
+    # The runner's signals are its own -- a ^C meant for it must not take the spawn server down first
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    with DefaultSelector() as selector:
+        selector.register(requests, EVENT_READ)
+        selector.register(wakeup_read, EVENT_READ)
+        while True:
+            for key, _ in selector.select():
+                if key.fileobj == wakeup_read:
+                    os.read(wakeup_read, 4096)
+                    reap(exits)
+                    continue
+
+                message, fds, _, _ = socket.recv_fds(requests, 1 << 20, MAX_FDS)
+                # Only their copies on 0, 1 and 2 are for the child
+                for x in fds:
+                    os.set_inheritable(x, False)
+                if not message:
+                    # The runner is gone -- its children carry on under init, like they would without the zygote
+                    return
+                try:
+                    reply = spawn(json.loads(message.decode('utf-8')), fds)
+                finally:
+                    for x in fds:
+                        os.close(x)
+                requests.send(json.dumps(reply).encode('utf-8'))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]), int(sys.argv[2]))
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# One-time conversion of task timestamps stored as formatted local-time strings into native UTC datetimes
+# usage: migrate_timestamps.py [batch size]
+
+import sys
+from time import mktime
+from datetime import datetime
+
+from pymongo import UpdateOne
+
+from lib import Client, Task, TIME_FORMAT
+
+
+def to_datetime(value):
+    if not isinstance(value, str):
+        return value
+    local = datetime.strptime(value, TIME_FORMAT)
+    return datetime.utcfromtimestamp(mktime(local.timetuple()))
+
+
+def pending_query():
+    return {'$or': [{k: {'$type': 'string'}} for k in Task.TIME_FIELDS + ('notes.timestamp',)]}
+
+
+def migrate(collection_name, batch_size=500):
+    converted = 0
+    while True:
+        operations = []
+        for row in Client.cursor(collection_name, pending_query(), sort=[('_id', 1)], limit=batch_size):
+            fields = {k: to_datetime(row[k]) for k in Task.TIME_FIELDS if isinstance(row.get(k), str)}
+            if any(isinstance(note.get('timestamp'), str) for note in row.get('notes') or []):
+                fields['notes'] = [dict(note, timestamp=to_datetime(note.get('timestamp'))) for note in row['notes']]
+            operations.append(UpdateOne({'_id': row['_id']}, {'$set': fields}))
+
+        if not operations:
+            return converted
+        converted += Client.bulk_write(collection_name, operations)
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    for name in ('task', Task.ARCHIVE):
+        print('{}: {} converted'.format(name, migrate(name, batch_size=size)))
@@ -1,16 +1,20 @@
 #!/usr/bin/env python
 
+import os
 import json
 import inspect
 from flask_pymongo import PyMongo
 from flask_cors import CORS
 from collections import namedtuple
-from flask import jsonify, Flask, request, make_response
+from flask import jsonify, Flask, request, make_response, Response, stream_with_context
 from flask.json import JSONEncoder
+from werkzeug.wsgi import wrap_file
 from subprocess import PIPE, Popen
 
 
-from lib import build_task, query, from_id, config, endpoints, states, Client, UserFault, stream_logger
+from lib import build_tasks, from_id, config, endpoints, states, Client, UserFault, ApplicationFault, \
+    stream_logger, notify_runner, Task, query_page, page_token, usage_summary, parse_range, tail_offset, read_range, \
+    follow_log
 
 
 class CustomEncoder(JSONEncoder):
@@ -28,6 +32,7 @@ FLASK_MONGO_DB = FLASK_MONGO_CONNECTION.db
 
 
 Client.override_client(FLASK_MONGO_DB)
+Client.ensure_indexes()
 
 
 app.json_encoder = CustomEncoder
@@ -92,6 +97,52 @@ def validate_post(request, post_key):
                               status_code=200)
 
 
+def wants_stream():
+    return request.args.get('stream') not in (None, '0') or \
+        request.accept_mimetypes.best == 'application/x-ndjson'
+
+
+def page_response(response, query_data, by_priority=False):
+    """
+    Fill response['output'] with one page of tasks for the query -- reads the limit, after and full url arguments
+    and sets response['next'] when another page may follow. Streams every match as NDJSON instead when the client
+    asks for it with ?stream=1 or Accept: application/x-ndjson
+    """
+    full = request.args.get('full') is not None
+    stream = wants_stream()
+
+    try:
+        cursor, limit = query_page(query_data,
+                                   limit=request.args.get('limit'),
+                                   after=request.args.get('after'),
+                                   by_priority=by_priority,
+                                   full=full,
+                                   paged=not stream)
+    except UserFault as e:
+        response['message'] = str(e)
+        return jsonify(response), 400
+
+    if stream:
+        def __lines(cursor):
+            for row in cursor:
+                yield json.dumps(Task.serialize(row, full=full), default=str) + '\n'
+
+        resp = Response(stream_with_context(__lines(cursor)), mimetype='application/x-ndjson')
+        resp.headers['X-Accel-Buffering'] = 'no'
+        return resp
+
+    last = None
+    count = 0
+    for row in cursor:
+        response['output'].append(Task.serialize(row, full=full))
+        last = row
+        count += 1
+
+    response['next'] = page_token(last, by_priority=by_priority) if count == limit else None
+
+    return jsonify(response), 200
+
+
 # ENDPOINTS -----------------------------------------------------
 
 @app.route('/')
@@ -108,19 +159,29 @@ def add_task():
     if status_code != 200:
         return jsonify(default_response), status_code
 
-    inserted = []
-    for req in post_data:
+    if not isinstance(post_data, list):
+        default_response['message'] = 'requests must be a list of task requests'
+        return jsonify(default_response), 500
 
-        try:
-            assert isinstance(req, dict), "Each request must be a dict -- " \
-                                          "this was what was received: req = '{}', type = '{}'".format(req, type(req))
+    for req in post_data:
+        if isinstance(req, dict):
             req.update({'host': request.host_url})
-            task = build_task(**req)
-            inserted.append(task.slim)
-        except (UserFault, AssertionError) as e:
-            default_response['message'] = str(e)
-            default_response['inserted'] = inserted
-            return jsonify(default_response), 500
+
+    try:
+        tasks, errors = build_tasks(post_data)
+    except (UserFault, ApplicationFault) as e:
+        default_response['message'] = str(e)
+        return jsonify(default_response), 500
+
+    inserted = [task.slim for task in tasks]
+    if inserted:
+        notify_runner()
+
+    if errors:
+        default_response['message'] = '{} of {} requests were not inserted'.format(len(errors), len(post_data))
+        default_response['inserted'] = inserted
+        default_response['errors'] = errors
+        return jsonify(default_response), 500 if not inserted else 200
 
     return jsonify({"inserted": inserted}), 200
 
@@ -134,15 +195,7 @@ def get_running():
         'message': 'Successful request'
     }
 
-    full = request.args.get('full') is not None
-
-    for task in query({'status': {'$in': states.running}}):
-        if full:
-            response['output'].append(task.full)
-        else:
-            response['output'].append(task.slim)
-
-    return jsonify(response), 200
+    return page_response(response, {'status': {'$in': states.running}})
 
 
 @app.route(endpoints.tasks_queued, methods=['GET'])
@@ -154,15 +207,7 @@ def get_queued():
         'message': 'Successful request'
     }
 
-    full = request.args.get('full') is not None
-
-    for queued in query({'status': {'$in': states.queued}}):
-        if full:
-            response['output'].append(queued.full)
-        else:
-            response['output'].append(queued.slim)
-
-    return jsonify(response), 200
+    return page_response(response, {'status': {'$in': states.queued}}, by_priority=True)
 
 
 @app.route(endpoints.tasks, methods=['GET'])
@@ -174,8 +219,6 @@ def query_task_states():
         'message': 'Successful request'
     }
 
-    full = request.args.get('full') is not None
-
     try:
         state = request.args.get('state')
         assert state
@@ -190,13 +233,7 @@ def query_task_states():
         response['message'] = 'State "{}" not found -- available states: {}'.format(state, ', '.join(states.keys))
         return jsonify(response), 404
 
-    for queued in query({'status': {'$in': state_query}}):
-        if full:
-            response['output'].append(queued.full)
-        else:
-            response['output'].append(queued.slim)
-
-    return jsonify(response), 200
+    return page_response(response, {'status': {'$in': state_query}})
 
 
 @app.route(endpoints.tasks_query, methods=['POST'])
@@ -207,15 +244,32 @@ def tasks_query():
     if status_code != 200:
         return jsonify(default_response), status_code
 
-    full = request.args.get('full') is not None
-
-    if full:
-        default_response['output'] = [x.full for x in query(post_data)]
-    else:
-        default_response['output'] = [x.slim for x in query(post_data)]
     default_response['method'] = inspect.currentframe().f_code.co_name
 
-    return jsonify(default_response), 200
+    return page_response(default_response, post_data)
+
+
+@app.route(endpoints.tasks_usage, methods=['GET'])
+def tasks_usage():
+
+    response = {
+        'method': inspect.currentframe().f_code.co_name,
+        'output': [],
+        'message': 'Successful request'
+    }
+
+    try:
+        response['output'] = usage_summary(by=request.args.get('by') or 'user',
+                                           depth=request.args.get('depth') or 1,
+                                           archived=request.args.get('archived') is not None)
+    except UserFault as e:
+        response['message'] = str(e)
+        return jsonify(response), 400
+    except ApplicationFault as e:
+        response['message'] = str(e)
+        return jsonify(response), 500
+
+    return jsonify(response), 200
 
 
 @app.route(endpoints.tasks_update, methods=['POST'])
@@ -224,32 +278,53 @@ def update_tasks():
     default_response, post_data, status_code = validate_post(request, 'ids')
 
     if status_code != 200:
-        return jsonify(default_response), status_code
+        # Filter form: {"where": {"state": "queued", "user": "x"}, "set": {"priority": 500}}
+        where_response, where, where_status = validate_post(request, 'where')
+        if where_status != 200:
+            return jsonify(default_response), status_code
+        return update_tasks_where(where_response, where, json.loads(request.data).get('set'))
+
+    if not isinstance(post_data, dict):
+        default_response['message'] = 'ids must be a dict of {id: {field: value}}'
+        return jsonify(default_response), 500
+
+    try:
+        written, ignored = Task.bulk_update(post_data)
+    except (UserFault, ApplicationFault) as e:
+        default_response['message'] = str(e)
+        return jsonify(default_response), 500
 
     updated = []
-    for _id, update_dict in post_data.items():
+    if written:
+        cursor = Client.cursor('task', {'_id': {'$in': written}}, projection=list(Task.SLIM_FIELDS))
+        updated = [Task.serialize(row) for row in cursor]
 
-        try:
-            task = from_id(str(_id))
-        except UserFault:
-            default_response['message'] = 'Invalid ID received: "{}"'.format(_id)
-            return jsonify(default_response), 500
+    if any(task['status'] in states.queued for task in updated):
+        notify_runner()
 
-        if not task:
-            continue
+    default_response['output'] = updated
+    if ignored:
+        default_response['ignored'] = ignored
+    return jsonify(default_response), 200
 
-        for k, v in update_dict.items():
-            try:
-                setattr(task, k, v)
-            except (UserFault, AttributeError, AssertionError):
-                pass
 
-        updated.append(task.slim)
+def update_tasks_where(response, where, fields):
 
-        task.commit()
+    response['method'] = 'update_tasks'
 
-    default_response['output'] = updated
-    return jsonify(default_response), 200
+    try:
+        modified, ignored = Task.update_where(where, fields)
+    except (UserFault, ApplicationFault) as e:
+        response['message'] = str(e)
+        return jsonify(response), 500
+
+    if modified and fields.get('status') in states.queued:
+        notify_runner()
+
+    response['output'] = {'modified': modified}
+    if ignored:
+        response['ignored'] = ignored
+    return jsonify(response), 200
 
 
 # /task ##########################################
@@ -280,22 +355,79 @@ def get_log(oid):
     t = from_id(str(oid))
 
     if not t:
-        resp = make_response('Task {} not found at this service -- '
-                             'try another service or double check the id'.format(oid), 404)
-        resp.headers['Content-Type'] = 'text/plain'
-        return resp
+        return __log_response('Task {} not found at this service -- '
+                              'try another service or double check the id'.format(oid), 404)
 
     try:
-        with open(t.log, 'rb') as f:
-            content = f.read()
-        resp = make_response(content, 200)
+        follow = request.args.get('follow') not in (None, '0')
+        offset = int(request.args.get('offset') or 0)
+        lines = int(request.args.get('tail') or 0)
+        assert offset >= 0 and lines >= 0, 'offset and tail must not be negative'
+    except (ValueError, AssertionError) as e:
+        return __log_response('Bad log request -- {}'.format(str(e)), 400)
+
+    try:
+        f = open(t.log, 'rb')
     except (IOError, OSError) as e:
-        resp = make_response('Unable to read from log file -- {}'.format(str(e)), 500)
+        return __log_response('Unable to read from log file -- {}'.format(str(e)), 500)
 
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if lines:
+            offset = tail_offset(f, lines)
+
+        if request.headers.get('Range') and not follow:
+            try:
+                span = parse_range(request.headers['Range'], size)
+            except ValueError as e:
+                f.close()
+                return __log_response('Bad range -- {}'.format(str(e)), 400)
+            if span is None:
+                f.close()
+                resp = __log_response('', 416)
+                resp.headers['Content-Range'] = 'bytes */{}'.format(size)
+                return resp
+
+            first, last = span
+            resp = Response(__closing(read_range(f, first, last - first + 1), f), 206, mimetype='text/plain')
+            resp.headers['Content-Range'] = 'bytes {}-{}/{}'.format(first, last, size)
+            resp.headers['Content-Length'] = str(last - first + 1)
+        elif follow:
+            # Holds a worker until the task completes -- the log is re-opened by the generator
+            f.close()
+
+            def __done():
+                return getattr(from_id(str(oid)), 'status', None) in states.complete
+
+            resp = Response(stream_with_context(follow_log(t.log, min(offset, size), __done)), mimetype='text/plain')
+            resp.headers['X-Accel-Buffering'] = 'no'
+        else:
+            # wsgi.file_wrapper lets the server sendfile the rest of the log instead of copying it through python
+            f.seek(min(offset, size))
+            resp = Response(wrap_file(request.environ, f), mimetype='text/plain', direct_passthrough=True)
+    except (IOError, OSError) as e:
+        f.close()
+        return __log_response('Unable to read from log file -- {}'.format(str(e)), 500)
+
+    resp.headers['Accept-Ranges'] = 'bytes'
+    resp.headers['X-Log-Offset'] = str(min(offset, size))
+    return resp
+
+
+def __log_response(message, code):
+    resp = make_response(message, code)
     resp.headers['Content-Type'] = 'text/plain'
     return resp
 
 
+def __closing(chunks, f):
+    try:
+        for chunk in chunks:
+            yield chunk
+    finally:
+        f.close()
+
+
 @app.route(endpoints.task_update, methods=['POST'])
 def update_task(oid):
 
@@ -320,6 +452,8 @@ def update_task(oid):
             pass
 
     task.commit()
+    if task.status in states.queued:
+        notify_runner()
 
     default_response['output'] = task.slim
     return jsonify(default_response), 200
@@ -2,11 +2,22 @@
 
 
 from time import sleep
-from lib import concurrency, get_next_queued, startup_callback, config, ProcPool, Thread, app_logger, stream_logger
+from lib import capacity_cpus, capacity_memory_mb, claim_queued, startup_callback, config, ProcPool, Thread, \
+    app_logger, stream_logger, listen_for_tasks, poll_interval, timeout_grace, output_tail, supervisor, Client, \
+    check_dispatch_index, check_indexes, archive, archive_complete, cgroup, CGroupTree, fair_share, claim_fair, \
+    FairPool, release_dependents, succeeded, notify_runner, TaskElement, micro_batch_size, spawner, heartbeat, \
+    reclaim_abandoned, heartbeat_interval
 # from web_service_handler import RequestHandler
 
 
-PROC_POOL = ProcPool(concurrency)
+CGROUPS = CGroupTree(cgroup.root, memory_max_mb=cgroup.memory_max_mb, pids_max=cgroup.pids_max) \
+    if cgroup and cgroup.root else None
+# Before the pool starts its zygote -- a process left in the parent group would make subtree_control fail with EBUSY
+if CGROUPS:
+    CGROUPS.setup()
+PROC_POOL = ProcPool(capacity_cpus, timeout_grace=timeout_grace, tail_size=output_tail, supervisor=supervisor,
+                     memory_mb=capacity_memory_mb, cgroups=CGROUPS, batch_size=micro_batch_size,
+                     spawner=spawner)
 EVENT_STREAM = PROC_POOL.event_stream
 PROC_DUMP = stream_logger('finished_procs') #path=config.runtime.task.finished_task_log)
 LOGGER = stream_logger('proc_run')
@@ -17,6 +28,14 @@ def process_event_stream():
         event = EVENT_STREAM.get()
         artifact = event.artifact
         LOGGER.debug('Artifact fetched: {}'.format(artifact))
+        if artifact.to_delete and not isinstance(artifact.to_delete, TaskElement):
+            # Tasks that depend on this one are released (or failed) as soon as it completes -- an array's dependents
+            # are released by its last element
+            try:
+                if release_dependents(artifact.to_delete.id, succeeded(artifact.to_delete.row)):
+                    notify_runner()
+            except Exception as e:
+                LOGGER.error('Releasing the dependents of {} failed: {}'.format(artifact.to_delete.id, e))
         if artifact.parent_url:
             continue
             # url = '{}/update'.format(artifact.parent_url)
@@ -40,8 +59,65 @@ t.start()
 del t
 
 
+def archive_tasks():
+    while True:
+        try:
+            archived = archive_complete(archive.after, batch_size=archive.batch_size or 500)
+            if archived:
+                LOGGER.info('Archived {} complete tasks'.format(archived))
+        except Exception as e:
+            LOGGER.error('Archiving failed: {}'.format(e))
+        sleep(archive.interval or 300)
+
+
+if archive and archive.after:
+    t = Thread(target=archive_tasks)
+    t.daemon = True
+    t.start()
+    del t
+
+
+def keep_alive():
+    while True:
+        try:
+            heartbeat()
+            reclaimed = reclaim_abandoned()
+            if reclaimed:
+                LOGGER.info('Re-queued {} tasks and arrays of runners that stopped sending heartbeats'
+                            .format(reclaimed))
+                notify_runner()
+        except Exception as e:
+            LOGGER.error('Heartbeat failed: {}'.format(e))
+        sleep(heartbeat_interval)
+
+
+# Dispatch without its index is a collection scan per slot -- refuse to start rather than degrade quietly
+Client.ensure_indexes(strict=True)
+if check_indexes:
+    check_dispatch_index()
+
+
+listen_for_tasks(PROC_POOL.wake)
+
+
+# Written before anything is claimed, so no other runner takes this one for gone
+heartbeat()
+reclaim_abandoned(startup=True)
+t = Thread(target=keep_alive)
+t.daemon = True
+t.start()
+del t
+
+
 def run():
-    PROC_POOL.start(startup_callback, get_next_queued)
+    if fair_share and fair_share.enabled:
+        # [user, weight] pairs -- user names are not always valid config keys
+        pool = FairPool(weights=dict(fair_share.weights or []),
+                        default_weight=fair_share.default_weight or 1)
+        PROC_POOL.start(startup_callback, lambda count: claim_fair(count, pool), poll_interval=poll_interval,
+                        priority_pool=pool)
+    else:
+        PROC_POOL.start(startup_callback, claim_queued, poll_interval=poll_interval)
 
 
 t = Thread(target=run)
@@ -0,0 +1,144 @@
+import os
+import sys
+from time import sleep
+from queue import Empty
+
+# manager is importable on its own, without lib's database connection -- the same way the zygote loads it
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from manager import ProcPool, PriorityPool, BatchProc, Proc, DeadlineHeap, SIGKILL
+
+
+class StubTask(object):
+    """
+    The fields admission and packing read off a task -- ordered and compared on priority alone, like lib.Task
+    """
+
+    def __init__(self, _id, priority=0, micro_batch=False):
+        self._id = _id
+        self.priority = priority
+        self.micro_batch = micro_batch
+        self.log = '/tmp/{}.log'.format(_id)
+        self.stdin = None
+        self.cpus = 1
+        self.memory_mb = None
+        self.timeout = None
+        self.cmd = ['true']
+        self.cwd = None
+        self.env = None
+        self.name = _id
+        self.parent_url = None
+        self.status = None
+
+    def __lt__(self, other):
+        return self.priority >= other.priority
+
+    def __le__(self, other):
+        return self.priority >= other.priority
+
+    def __eq__(self, other):
+        return self.priority == other.priority
+
+    __hash__ = object.__hash__
+
+
+def admit(monkeypatch, tasks, batch_size=4):
+    launched, batches = [], []
+    monkeypatch.setattr(ProcPool, '_ProcPool__launch_proc', lambda self, proc: launched.append(proc.task))
+    monkeypatch.setattr(ProcPool, '_ProcPool__launch_batch', lambda self, batch: batches.append(batch.tasks))
+    pool = ProcPool(4, batch_size=batch_size)
+    pool._ProcPool__admit(PriorityPool(tasks))
+    return launched, batches
+
+
+def test_pack_keeps_plain_task_next_to_batchable_one_of_same_priority(monkeypatch):
+    plain, micro = StubTask('plain'), StubTask('micro', micro_batch=True)
+
+    launched, batches = admit(monkeypatch, [plain, micro])
+
+    assert [x._id for x in launched] == ['plain']
+    assert [[x._id for x in batch] for batch in batches] == [['micro']]
+
+
+def test_pack_batches_matching_tasks_and_launches_the_rest_once(monkeypatch):
+    tasks = [StubTask('micro-1', micro_batch=True), StubTask('plain-1'), StubTask('micro-2', micro_batch=True),
+             StubTask('plain-2')]
+
+    launched, batches = admit(monkeypatch, tasks)
+
+    assert sorted(x._id for x in launched) == ['plain-1', 'plain-2']
+    assert [sorted(x._id for x in batch) for batch in batches] == [['micro-1', 'micro-2']]
+
+
+def test_batch_that_raises_still_completes(monkeypatch):
+    def fail(self):
+        raise RuntimeError('commit_many failed')
+
+    monkeypatch.setattr(BatchProc, 'run', fail)
+    tasks = [StubTask('micro-1', micro_batch=True), StubTask('micro-2', micro_batch=True)]
+    pool = ProcPool(4, batch_size=4)
+    pool.capacity.hold(tasks[0])
+
+    pool._ProcPool__launch_batch(BatchProc(tasks, None))
+
+    events = []
+    try:
+        while len(events) < 3:
+            events.append(pool.event_stream.get(timeout=5))
+    except Empty:
+        pass
+    assert events[0].artifact.status == Proc.PROCESSING
+    assert [x.artifact.to_delete._id for x in events[1:]] == ['micro-1', 'micro-2']
+    # The slot goes back right after the last event
+    for _ in range(50):
+        if not len(pool.capacity):
+            break
+        sleep(0.1)
+    assert not len(pool.capacity) and not pool.pool
+
+
+def test_deadline_heap_drops_cancelled_entries_once_they_are_half_of_it():
+    deadlines = DeadlineHeap()
+    entries = [deadlines.schedule(3600, lambda: None) for _ in range(10)]
+
+    for entry in entries[:5]:
+        deadlines.cancel(entry)
+    assert len(deadlines) == 10
+    deadlines.cancel(entries[5])
+    deadlines.cancel(entries[5])
+
+    assert len(deadlines) == 4 and deadlines.cancelled == 0
+
+
+def test_deadline_heap_cancel_after_the_entry_fired_is_a_noop():
+    deadlines = DeadlineHeap()
+    fired = []
+    entry = deadlines.schedule(0, fired.append, 1)
+    for _ in range(50):
+        if fired:
+            break
+        sleep(0.1)
+
+    deadlines.cancel(entry)
+
+    assert fired == [1] and deadlines.cancelled == 0 and not len(deadlines)
+
+
+def test_kill_after_the_grace_skips_completed_procs():
+    class StubProc(object):
+        name = 'task'
+
+        def __init__(self):
+            self.signals = []
+
+        def signal_group(self, sig):
+            self.signals.append(sig)
+
+    pool = ProcPool(4)
+    done, running = StubProc(), StubProc()
+    pool[running.name] = running
+
+    pool._ProcPool__kill_proc(done)
+    pool._ProcPool__kill_proc(running)
+
+    assert done.signals == [] and running.signals == [SIGKILL]